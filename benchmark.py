@@ -0,0 +1,77 @@
+import time
+import tracemalloc
+
+from bson.objectid import ObjectId
+
+import db
+from dbmodels import UserModel, TripModel
+
+
+def trip_documents(count):
+  author = 'UserModel:%s' % ObjectId()
+  return [
+    { '_id': ObjectId(), 'name': 'Trip %d' % i, 'author': author }
+    for i in range(count)
+  ]
+
+
+def measure(build, documents):
+  tracemalloc.start()
+  start = time.perf_counter()
+  built = [build(document) for document in documents]
+  elapsed = time.perf_counter() - start
+  size, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  # the list holding the results is not part of an entity's cost
+  per_entity = (size - len(built) * 8) / len(built)
+  return per_entity, elapsed / len(built) * 1e6
+
+
+def BenchmarkEntityMemory(count=10000):
+  # Builds TripModel results straight from documents, no database needed
+  documents = trip_documents(count)
+  key_from_id = TripModel.key_from_id
+
+  print('TripModel x %d' % count)
+  print('%-10s %16s %16s' % ('', 'bytes/entity', 'us/entity'))
+
+  def entity(document):
+    return TripModel.from_document(document)
+  print('%-10s %16.0f %16.2f' % (('entity',) + measure(entity, documents)))
+
+  def row(document):
+    return TripModel.Row.from_document(document, key_from_id(str(document['_id'])))
+  print('%-10s %16.0f %16.2f' % (('compact',) + measure(row, documents)))
+
+
+def timed(run):
+  start = time.perf_counter()
+  result = run()
+  return result, time.perf_counter() - start
+
+
+def BenchmarkMemoryBackend(count=10000):
+  # Runs saves, queries and loads against the in memory storage
+  # backend, no mongod needed
+  db.set_backend(db.MemoryBackend())
+  db.ensure_indexes(TripModel)
+  author = UserModel.key_from_id(str(ObjectId()))
+  trips = [TripModel(name='Trip %d' % i, author=author) for i in range(count)]
+
+  print('TripModel x %d, memory backend' % count)
+  print('%-10s %16s' % ('', 'us/entity'))
+
+  _, elapsed = timed(lambda: db.Model.put_multi(trips))
+  print('%-10s %16.2f' % ('put_multi', elapsed / count * 1e6))
+
+  fetched, elapsed = timed(lambda: TripModel.fetch(TripModel.author == author))
+  print('%-10s %16.2f' % ('fetch', elapsed / len(fetched) * 1e6))
+
+  keys = [trip.key for trip in trips]
+  _, elapsed = timed(lambda: TripModel.get_multi(keys))
+  print('%-10s %16.2f' % ('get_multi', elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+  BenchmarkEntityMemory()
+  BenchmarkMemoryBackend()
@@ -1,6 +1,16 @@
 """ LOCAL IMPORTS """
+from .cache import LRUCache, entity_cache
+from .connection import configure, pool_stats
+from .context import start_request, end_request
+from .aio import set_executor
+from .errors import MultiWriteError, DuplicateKeyError, PartialEntityError, ConcurrentModificationError
+from .indexes import Index, ensure_indexes
+from .storage import StorageBackend, MongoBackend, set_backend, get_backend
+from .memory import MemoryBackend
 from .key import Key
+from .rows import Row
 from .model import Model
+from .prefetch import prefetch
 from .properties import *
 from .query import *
 
@@ -0,0 +1,124 @@
+""" GLOBAL IMPORTS """
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+""" EXECUTOR STATE """
+_lock = threading.Lock()
+_executor = None
+_pid = None
+_max_workers = 16
+
+
+def set_executor(max_workers=16):
+  """
+  ' PURPOSE
+  '   Sets how many threads run blocking database calls for the async
+  '   API. The pool is created on first use, and again in a process
+  '   forked after it was created.
+  ' PARAMETERS
+  '   optional <int max_workers> the most database calls in flight
+  ' RETURNS
+  '   Nothing
+  ' NOTES
+  '   1. There is no point in more workers than the connection pool's
+  '      max_pool_size, extra ones only wait for a connection.
+  """
+  global _executor, _pid, _max_workers
+  with _lock:
+    if _executor is not None and _pid == os.getpid():
+      _executor.shutdown(wait=False)
+    _executor = None
+    _pid = None
+    _max_workers = max_workers
+
+
+def executor():
+  """
+  ' PURPOSE
+  '   Returns the thread pool running blocking database calls.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   <concurrent.futures.ThreadPoolExecutor executor>
+  """
+  global _executor, _pid
+  pid = os.getpid()
+  if _executor is not None and _pid == pid:
+    return _executor
+  with _lock:
+    if _executor is None or _pid != pid:
+      _executor = ThreadPoolExecutor(max_workers=_max_workers)
+      _pid = pid
+  return _executor
+
+
+def run(function, *args, **kwargs):
+  """
+  ' PURPOSE
+  '   Runs a blocking db function on the thread pool and returns an
+  '   awaitable for its result. The call runs in a copy of the
+  '   caller's context, so it uses the identity map of the task that
+  '   awaits it.
+  ' PARAMETERS
+  '   <function function>
+  '   <*args args>
+  '   <**kwargs kwargs>
+  ' RETURNS
+  '   <asyncio.Future future>
+  ' EXAMPLE USAGE
+  '   -> user = await db.aio.run(UserModel.get_by_id, id)
+  """
+  context = contextvars.copy_context()
+  call = functools.partial(context.run, function, *args, **kwargs)
+  return asyncio.get_event_loop().run_in_executor(executor(), call)
+
+
+class AsyncIterator(object):
+  """
+  ' PURPOSE
+  '   Iterates a blocking iterator from a coroutine, pulling batch_size
+  '   items per trip to the thread pool.
+  ' EXAMPLE USAGE
+  '   -> async for trip in TripModel.query(TripModel.author == key):
+  '   ->   print(trip.name)
+  """
+
+  def __init__(self, iterable, batch_size=100):
+    """
+    ' PURPOSE
+    '   Initializes the iterator, nothing is read until the first item
+    '   is awaited.
+    ' PARAMETERS
+    '   <iterable iterable> evaluated lazily on the thread pool
+    '   optional <int batch_size> items pulled per trip
+    ' RETURNS
+    '   <AsyncIterator iterator>
+    """
+    self._iterable = iterable
+    self._iterator = None
+    self._batch_size = batch_size
+    self._batch = []
+    self._done = False
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if not self._batch and not self._done:
+      self._batch = await run(self._next_batch)
+      self._batch.reverse()
+      self._done = len(self._batch) < self._batch_size
+    if not self._batch:
+      raise StopAsyncIteration
+    return self._batch.pop()
+
+  def _next_batch(self):
+    if self._iterator is None:
+      self._iterator = iter(self._iterable)
+    return list(islice(self._iterator, self._batch_size))
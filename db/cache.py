@@ -0,0 +1,242 @@
+""" GLOBAL IMPORTS """
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LRUCache(object):
+  """
+  ' PURPOSE
+  '   A thread safe, bounded, least recently used cache with an
+  '   optional time to live. Keeps hit, miss, and eviction counters
+  '   so that its effectiveness can be monitored.
+  ' EXAMPLE USAGE
+  '   -> cache = LRUCache(maxsize=2, ttl=60)
+  '   -> cache.set('a', 1)
+  '   -> cache.get('a') # 1
+  '   -> cache.get('b') # None
+  '   -> cache.stats()  # { 'hits': 1, 'misses': 1, ... }
+  """
+
+  def __init__(self, maxsize=1024, ttl=None):
+    """
+    ' PURPOSE
+    '   Initializes an empty cache.
+    ' PARAMETERS
+    '   optional <int maxsize> the max amount of items held at once
+    '   optional <float ttl> seconds an item stays valid, None for forever
+    ' RETURNS
+    '   <LRUCache cache>
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+    # a tick bumped by every discard, remembering for the most recently
+    # discarded keys when they were discarded. Ticks older than _floor
+    # are forgotten, so any read started before _floor counts as stale.
+    self._tick = 0
+    self._floor = 0
+    self._discarded = OrderedDict()
+
+  def get(self, key):
+    """
+    ' PURPOSE
+    '   Returns the value held for the given key and marks it as
+    '   the most recently used.
+    ' PARAMETERS
+    '   <str key>
+    ' RETURNS
+    '   <object value> if held and not expired
+    '   None otherwise
+    """
+    with self._lock:
+      item = self._items.get(key)
+      if item and item[0] and item[0] < time.monotonic():
+        del self._items[key]
+        self.evictions += 1
+        item = None
+      if not item:
+        self.misses += 1
+        return None
+      self._items.move_to_end(key)
+      self.hits += 1
+      return item[1]
+
+  def generation(self):
+    """
+    ' PURPOSE
+    '   Returns the cache's current generation. A reader takes it
+    '   before reading the value it will set, see set.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <int generation>
+    """
+    with self._lock:
+      return self._tick
+
+  def set(self, key, value, generation=None):
+    """
+    ' PURPOSE
+    '   Holds a value for the given key, evicting the least recently
+    '   used items if the cache is full.
+    ' PARAMETERS
+    '   <str key>
+    '   <object value>
+    '   optional <int generation> when the value was read, see generation
+    ' RETURNS
+    '   <bool held> False if the key was discarded after the generation
+    ' NOTES
+    '   1. Passing the generation taken before a read keeps a slow read
+    '      that raced a write from holding the value the write replaced.
+    """
+    expires = time.monotonic() + self.ttl if self.ttl else None
+    with self._lock:
+      if generation is not None and (
+          generation < self._floor or self._discarded.get(key, -1) > generation):
+        return False
+      self._items[key] = (expires, value)
+      self._items.move_to_end(key)
+      while len(self._items) > self.maxsize:
+        self._items.popitem(last=False)
+        self.evictions += 1
+      return True
+
+  def discard(self, key):
+    """
+    ' PURPOSE
+    '   Stops holding the value for the given key, if any.
+    ' PARAMETERS
+    '   <str key>
+    ' RETURNS
+    '   Nothing
+    """
+    with self._lock:
+      self._items.pop(key, None)
+      self._forget(key)
+
+  def purge(self, predicate):
+    """
+    ' PURPOSE
+    '   Stops holding every item whose key and value match the
+    '   given predicate.
+    ' PARAMETERS
+    '   <function predicate(key, value) -> bool>
+    ' RETURNS
+    '   <int purged> the number of items no longer held
+    ' NOTES
+    '   1. Values read before the purge are no longer held by set
+    '      when given their generation.
+    """
+    with self._lock:
+      matches = [key for key, item in self._items.items() if predicate(key, item[1])]
+      for key in matches:
+        del self._items[key]
+      # the keys a read in flight will set cannot be matched, so every
+      # read started before the purge is treated as stale
+      self._tick += 1
+      self._floor = self._tick
+      return len(matches)
+
+  def clear(self):
+    """
+    ' PURPOSE
+    '   Stops holding every item. Counters are left untouched.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   Nothing
+    """
+    with self._lock:
+      self._items.clear()
+      self._tick += 1
+      self._floor = self._tick
+      self._discarded.clear()
+
+  def stats(self):
+    """
+    ' PURPOSE
+    '   Returns the cache's counters.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   dict( size, maxsize, hits, misses, evictions )
+    """
+    with self._lock:
+      return {
+        'size': len(self._items),
+        'maxsize': self.maxsize,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions
+      }
+
+  def __len__(self):
+    """
+    ' PURPOSE
+    '   Returns the amount of items currently held.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <int size>
+    """
+    return len(self._items)
+
+  def _forget(self, key):
+    """
+    ' PURPOSE
+    '   A private method used to record that the given key was
+    '   discarded, must be called holding the lock.
+    ' PARAMETERS
+    '   <str key>
+    ' RETURNS
+    '   Nothing
+    """
+    self._tick += 1
+    self._discarded[key] = self._tick
+    self._discarded.move_to_end(key)
+    while len(self._discarded) > self.maxsize:
+      _, tick = self._discarded.popitem(last=False)
+      self._floor = max(self._floor, tick)
+
+
+""" PROCESS WIDE ENTITY CACHE """
+# Holds raw documents keyed by Key.serialize() for models that opt in
+# via their __cache__ class attribute. Documents rather than entities
+# are held so that separate requests never share mutable instances.
+# The ttl bounds how stale an entry can get when another process
+# writes the same document.
+entity_cache = LRUCache(maxsize=4096, ttl=60)
+
+
+@contextmanager
+def uncache_after(model, keys):
+  """
+  ' PURPOSE
+  '   Discards the given keys from the entity cache once the wrapped
+  '   write is done, whether or not it succeeded, when the model opted
+  '   into the cache.
+  ' PARAMETERS
+  '   <class model extends Model>
+  '   <list Key keys>
+  ' RETURNS
+  '   <contextmanager>
+  ' EXAMPLE USAGE
+  '   -> with uncache_after(Trip, [trip.key]):
+  '   ->   collection.update_one(selector, changes)
+  ' NOTES
+  '   1. Discarding after rather than before the write keeps a read
+  '      racing the write from caching the old document again, and
+  '      bumps the generation so a read that started before it cannot
+  '      either, see LRUCache.set.
+  """
+  try:
+    yield
+  finally:
+    if model.__cache__:
+      for key in keys: entity_cache.discard(key.serialize())
@@ -0,0 +1,267 @@
+""" GLOBAL IMPORTS """
+import os
+import threading
+import time
+
+
+""" MONGO IMPORTS """
+from pymongo import MongoClient
+try:
+  from pymongo import monitoring
+  ConnectionPoolListener = monitoring.ConnectionPoolListener
+except (ImportError, AttributeError):
+  # pool events only exist in pymongo 3.9 and later
+  ConnectionPoolListener = None
+
+
+""" TIMEOUT OPTIONS """
+TIMEOUTS = {
+  'connect': 'connectTimeoutMS',
+  'socket': 'socketTimeoutMS',
+  'server_selection': 'serverSelectionTimeoutMS',
+  'wait_queue': 'waitQueueTimeoutMS'
+}
+
+
+""" CONNECTION STATE """
+_settings = {
+  'uri': 'mongodb://localhost:27017',
+  'database': 'develop_database',
+  'options': {}
+}
+_lock = threading.Lock()
+_client = None
+_pid = None
+
+
+class PoolStats(object):
+  """
+  ' PURPOSE
+  '   Records how long threads wait to check a connection out of
+  '   the pool. Registered as a pymongo pool listener when the
+  '   installed pymongo supports pool monitoring.
+  ' EXAMPLE USAGE
+  '   -> db.pool_stats() # { 'checkouts': 10, 'max_wait': 0.002, ... }
+  """
+
+  def __init__(self):
+    """
+    ' PURPOSE
+    '   Initializes empty counters.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <PoolStats stats>
+    """
+    self.checkouts = 0
+    self.failures = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def started(self):
+    """
+    ' PURPOSE
+    '   Records that the calling thread started waiting for a
+    '   connection.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   Nothing
+    """
+    self._local.started = time.monotonic()
+
+  def finished(self, failed=False):
+    """
+    ' PURPOSE
+    '   Records that the calling thread stopped waiting for a
+    '   connection, counting how long it waited.
+    ' PARAMETERS
+    '   optional <bool failed> True if no connection was checked out
+    ' RETURNS
+    '   Nothing
+    ' NOTES
+    '   1. Failed checkouts are counted but their waits are not.
+    """
+    started = getattr(self._local, 'started', None)
+    if started is None:
+      return
+    self._local.started = None
+    wait = time.monotonic() - started
+    with self._lock:
+      if failed:
+        self.failures += 1
+        return
+      self.checkouts += 1
+      self.total_wait += wait
+      self.max_wait = max(self.max_wait, wait)
+
+  def reset(self):
+    """
+    ' PURPOSE
+    '   Sets every counter back to zero.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   Nothing
+    """
+    with self._lock:
+      self.checkouts = 0
+      self.failures = 0
+      self.total_wait = 0.0
+      self.max_wait = 0.0
+
+  def to_dict(self):
+    """
+    ' PURPOSE
+    '   Returns a snapshot of the checkout wait counters.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict stats>
+    """
+    with self._lock:
+      return {
+        'monitored': ConnectionPoolListener is not None,
+        'checkouts': self.checkouts,
+        'failures': self.failures,
+        'total_wait': self.total_wait,
+        'mean_wait': self.total_wait / self.checkouts if self.checkouts else 0.0,
+        'max_wait': self.max_wait
+      }
+
+
+_pool_stats = PoolStats()
+
+
+if ConnectionPoolListener is not None:
+  class _PoolListener(ConnectionPoolListener):
+    """
+    ' PURPOSE
+    '   Forwards pymongo's checkout events to the PoolStats counters.
+    '   Every other pool event is ignored.
+    """
+
+    def connection_check_out_started(self, event):
+      _pool_stats.started()
+
+    def connection_checked_out(self, event):
+      _pool_stats.finished()
+
+    def connection_check_out_failed(self, event):
+      _pool_stats.finished(failed=True)
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+def configure(uri=None, database=None, max_pool_size=None, min_pool_size=None,
+              timeouts=None, read_preference=None, write_concern=None, **options):
+  """
+  ' PURPOSE
+  '   Sets how the database is connected to. No connection is made
+  '   here, the client is created on first use. Reconfiguring drops
+  '   the current client so the next use connects with the new
+  '   settings.
+  ' PARAMETERS
+  '   optional <str uri> the mongodb:// connection string
+  '   optional <str database> the name of the database to use
+  '   optional <int max_pool_size> the max connections per server
+  '   optional <int min_pool_size> the connections kept open per server
+  '   optional <dict timeouts> millisecond timeouts keyed by connect,
+  '                            socket, server_selection or wait_queue
+  '   optional <str read_preference> e.g. 'secondaryPreferred'
+  '   optional <dict write_concern> e.g. { 'w': 'majority', 'j': True }
+  '   optional <**kwargs options> passed to MongoClient untouched
+  ' RETURNS
+  '   Nothing
+  ' EXAMPLE USAGE
+  '   -> db.configure('mongodb://db1,db2/?replicaSet=rs0', 'trips',
+  '                   max_pool_size=50, timeouts={ 'wait_queue': 500 })
+  """
+  global _client, _pid
+  options = dict(options)
+  if max_pool_size is not None:
+    options['maxPoolSize'] = max_pool_size
+  if min_pool_size is not None:
+    options['minPoolSize'] = min_pool_size
+  for name, value in (timeouts or {}).items():
+    if name not in TIMEOUTS:
+      raise ValueError('Unknown timeout %r, expected one of %s' % (name, ', '.join(sorted(TIMEOUTS))))
+    options[TIMEOUTS[name]] = value
+  if read_preference is not None:
+    options['readPreference'] = read_preference
+  options.update(write_concern or {})
+
+  with _lock:
+    if uri is not None:
+      _settings['uri'] = uri
+    if database is not None:
+      _settings['database'] = database
+    _settings['options'] = options
+    if _client is not None and _pid == os.getpid():
+      _client.close()
+    _client = None
+    _pid = None
+
+
+def client():
+  """
+  ' PURPOSE
+  '   Returns the MongoClient, creating it on first use. A process
+  '   forked after the client was created (a pre-fork WSGI worker)
+  '   gets its own client since pymongo clients are not fork safe.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   <MongoClient client>
+  """
+  global _client, _pid
+  pid = os.getpid()
+  if _client is not None and _pid == pid:
+    return _client
+  with _lock:
+    if _client is None or _pid != pid:
+      options = dict(_settings['options'])
+      if ConnectionPoolListener is not None:
+        options['event_listeners'] = list(options.get('event_listeners', [])) + [_PoolListener()]
+      if _pid is not None:
+        # forked, the parent's client is left alone since closing
+        # it here would close sockets the parent still uses
+        _pool_stats.reset()
+      _client = MongoClient(_settings['uri'], connect=False, **options)
+      _pid = pid
+  return _client
+
+
+def database():
+  """
+  ' PURPOSE
+  '   Returns the configured database, connecting lazily.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   <pymongo.database.Database database>
+  """
+  return client()[_settings['database']]
+
+
+def pool_stats():
+  """
+  ' PURPOSE
+  '   Returns the pool checkout wait counters of this process. The
+  '   'monitored' flag is False when the installed pymongo has no
+  '   pool monitoring, in which case the counters stay at zero.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   <dict stats>
+  """
+  return _pool_stats.to_dict()
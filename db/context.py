@@ -0,0 +1,128 @@
+""" GLOBAL IMPORTS """
+from contextvars import ContextVar
+
+
+""" CONTEXT LOCAL STATE """
+# a context variable rather than a thread local, every thread and every
+# asyncio task has its own, so concurrent coroutines on one event loop
+# never share an identity map
+_identity_map = ContextVar('identity_map', default=None)
+
+
+class IdentityMap(object):
+  """
+  ' PURPOSE
+  '   Holds at most one entity instance per key for the duration
+  '   of a request so that repeated loads of the same entity are
+  '   answered from memory instead of the database.
+  ' EXAMPLE USAGE
+  '   Identity maps are not created directly, instead a request
+  '   is started and ended around the code that should share one.
+  '
+  '   -> db.start_request()
+  '   -> user = UserModel.get_by_id(id)
+  '   -> user is UserModel.get_by_id(id) # True, no second query
+  '   -> db.end_request()
+  """
+
+  def __init__(self):
+    """
+    ' PURPOSE
+    '   Initializes an empty identity map.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <IdentityMap identity_map>
+    """
+    self._entities = {}
+
+  def get(self, key):
+    """
+    ' PURPOSE
+    '   Returns the entity held for the given key.
+    ' PARAMETERS
+    '   <Key key>
+    ' RETURNS
+    '   <MyModel extends Model entity> if held
+    '   None if not held
+    """
+    return self._entities.get(key.serialize())
+
+  def put(self, entity):
+    """
+    ' PURPOSE
+    '   Holds the given entity, replacing any other instance
+    '   previously held for the same key.
+    ' PARAMETERS
+    '   <MyModel extends Model entity>
+    ' RETURNS
+    '   Nothing
+    """
+    self._entities[entity.key.serialize()] = entity
+
+  def discard(self, key):
+    """
+    ' PURPOSE
+    '   Stops holding the entity for the given key, if any.
+    ' PARAMETERS
+    '   <Key key>
+    ' RETURNS
+    '   Nothing
+    """
+    self._entities.pop(key.serialize(), None)
+
+  def discard_kind(self, model):
+    """
+    ' PURPOSE
+    '   Stops holding every entity of the given model.
+    ' PARAMETERS
+    '   <class MyModel extends Model>
+    ' RETURNS
+    '   Nothing
+    """
+    prefix = '%s:' % model.__name__
+    for serial in list(self._entities):
+      if serial.startswith(prefix):
+        del self._entities[serial]
+
+
+def start_request():
+  """
+  ' PURPOSE
+  '   Starts a new identity map for the current thread or asyncio
+  '   task. Every load made by it until end_request is called
+  '   consults and fills it.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   Nothing
+  """
+  _identity_map.set(IdentityMap())
+
+
+def end_request():
+  """
+  ' PURPOSE
+  '   Discards the identity map of the current thread or asyncio
+  '   task.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   Nothing
+  """
+  _identity_map.set(None)
+
+
+def identity_map():
+  """
+  ' PURPOSE
+  '   Returns the identity map of the current thread or asyncio
+  '   task.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   <IdentityMap identity_map> if a request was started
+  '   None if no request was started
+  """
+  return _identity_map.get()
+
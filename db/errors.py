@@ -0,0 +1,49 @@
+class DuplicateKeyError(ValueError):
+  """
+  ' PURPOSE
+  '   Raised when saving an entity would break a unique index.
+  """
+
+
+class PartialEntityError(ValueError):
+  """
+  ' PURPOSE
+  '   Raised when saving an entity that was loaded with a
+  '   projection and hence does not hold all of its data.
+  """
+
+
+class ConcurrentModificationError(ValueError):
+  """
+  ' PURPOSE
+  '   Raised when saving an entity of a versioned model that was
+  '   modified by someone else since it was loaded.
+  """
+
+
+class MultiWriteError(ValueError):
+  """
+  ' PURPOSE
+  '   Raised by batched writes when some of the operations
+  '   failed. The operations that succeeded are still applied.
+  ' EXAMPLE USAGE
+  '   -> try:
+  '   ->   db.Model.put_multi(entities)
+  '   -> except db.MultiWriteError as error:
+  '   ->   for entity, message in zip(entities, error.errors):
+  '   ->     if message: print(entity, message)
+  """
+
+  def __init__(self, errors):
+    """
+    ' PURPOSE
+    '   Initializes the error with the per-operation errors.
+    ' PARAMETERS
+    '   <list str errors> one item per requested operation, None if
+    '                     that operation succeeded
+    ' RETURNS
+    '   <MultiWriteError error>
+    """
+    failed = len([error for error in errors if error])
+    super(MultiWriteError, self).__init__('%d of %d writes failed' % (failed, len(errors)))
+    self.errors = errors
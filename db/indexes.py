@@ -0,0 +1,124 @@
+""" MONGO IMPORTS """
+from pymongo import ASCENDING, DESCENDING
+
+
+class Index(object):
+  """
+  ' PURPOSE
+  '   Describes a compound index over several properties of a
+  '   model. Listed in a model's __indexes__ and created by
+  '   ensure_indexes.
+  ' EXAMPLE USAGE
+  '   Property names may be prefixed with '-' to index them in
+  '   descending order. Plain tuples of names may be used instead
+  '   of Index instances when the index needs no options.
+  '
+  '   -> class Trip(db.Model):
+  '   ->   name = db.StringProperty()
+  '   ->   author = db.KeyProperty()
+  '   ->   __indexes__ = [db.Index('author', '-name', unique=True)]
+  """
+
+  def __init__(self, *names, unique=False):
+    """
+    ' PURPOSE
+    '   Initializes the index with the indexed property names.
+    ' PARAMETERS
+    '   <str name1>
+    '   <str name2>
+    '   ...
+    '   <str nameN>
+    '   optional <bool unique> whether the indexed values must be unique
+    ' RETURNS
+    '   <Index index>
+    """
+    if not names:
+      raise ValueError('An index requires at least one property name')
+    self.names = names
+    self.unique = unique
+
+  def spec(self):
+    """
+    ' PURPOSE
+    '   Returns the index in PyMongo's create_index format.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <list (str name, int direction)>
+    """
+    return [
+      (name[1:], DESCENDING) if name.startswith('-') else (name, ASCENDING)
+      for name in self.names
+    ]
+
+
+def model_indexes(modelcls):
+  """
+  ' PURPOSE
+  '   Returns every index declared by a model, both through its
+  '   properties and through its __indexes__.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  ' RETURNS
+  '   <list Index indexes>
+  """
+  indexes = []
+  for name, prop in modelcls._schema:
+    if prop.indexed or prop.unique:
+      indexes.append(Index(name, unique=prop.unique))
+  for index in modelcls.__indexes__:
+    if not isinstance(index, Index):
+      index = Index(*index)
+    indexes.append(index)
+  return indexes
+
+
+def ensure_indexes(*models):
+  """
+  ' PURPOSE
+  '   Creates the declared indexes of the given models, or of every
+  '   model if none are given. Indexes that already exist are left
+  '   untouched so this is safe to call on every startup.
+  ' PARAMETERS
+  '   optional <class MyModel1 extends Model>
+  '   ...
+  '   optional <class MyModelN extends Model>
+  ' RETURNS
+  '   <list str names> the names of the ensured indexes
+  ' NOTES
+  '   1. Creating a unique index fails if the collection already
+  '      holds duplicate values.
+  """
+  from .model import ModelMeta
+  from .storage import get_collection
+  names = []
+  # every registered model, however deep its subclassing
+  for model in models or list(ModelMeta.models.values()):
+    collection = get_collection(model.__name__)
+    for index in model_indexes(model):
+      names.append(collection.create_index(index.spec(), unique=index.unique, background=True))
+  return names
+
+
+def expected_index(modelcls, fields):
+  """
+  ' PURPOSE
+  '   Returns the declared index of a model that best serves a query
+  '   filtering on the given fields, the one whose leading properties
+  '   cover the most of them.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  '   <list str fields> the fields filtered with indexable operators
+  ' RETURNS
+  '   <Index index> if an index leads with one of the fields
+  '   None if the query would scan the collection
+  """
+  best, best_covered = None, 0
+  for index in model_indexes(modelcls):
+    covered = 0
+    for name, direction in index.spec():
+      if name not in fields: break
+      covered += 1
+    if covered > best_covered:
+      best, best_covered = index, covered
+  return best
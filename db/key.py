@@ -6,6 +6,10 @@ import base64
 # At the bottom of the file
 
 
+# the _prefetched value of a key db.prefetch has not resolved
+NOT_PREFETCHED = object()
+
+
 class Key(object):
   """
   ' PURPOSE
@@ -23,6 +27,10 @@ class Key(object):
   '   ->  entity = Key(urlsafe = 'askjhd872hd92jio34==').get()
   """
 
+  # keys are created for every loaded entity and KeyProperty value,
+  # _prefetched is only set once db.prefetch attaches an entity
+  __slots__ = ('model', 'id', '_prefetched')
+
   @classmethod
   def get_model(self, modelname):
     """
@@ -36,13 +44,37 @@ class Key(object):
     '   1. The subclass must have already been imported and thus
     '      already exists in memory.
     """
-    models = Model.__subclasses__()
-    for model in models:
-      if modelname == model.__name__:
-        return model
-        break
-    else:
+    model = ModelMeta.models.get(modelname)
+    if not model:
       raise ValueError('Invalid modelname')
+    return model
+
+  @staticmethod
+  def get_multi(keys):
+    """
+    ' PURPOSE
+    '   Gets the entities associated with many keys at once using
+    '   one query per model kind. See Model.get_multi for details.
+    ' PARAMETERS
+    '   <list Key keys>
+    ' RETURNS
+    '   <list MyModel extends Model entity or None> in the same
+    '   order as the provided keys
+    """
+    return Model.get_multi(keys)
+
+  @staticmethod
+  def delete_multi(keys):
+    """
+    ' PURPOSE
+    '   Deletes the entities associated with many keys at once using
+    '   one bulk write per model kind. See Model.delete_multi for details.
+    ' PARAMETERS
+    '   <list Key keys>
+    ' RETURNS
+    '   <int deleted> the number of deleted entities
+    """
+    return Model.delete_multi(keys)
 
   def __init__(self, model=None, id=None, urlsafe=None, serial=None):
     """
@@ -111,10 +143,15 @@ class Key(object):
     ' RETURNS
     '   <int deleted> the number of deleted entities
     """
-    from .model import rawdb, ObjectId
-    collection = getattr(rawdb, self.model.__name__)
-    result = collection.remove({ '_id': ObjectId(self.id) })
-    return result['n']
+    from .model import ObjectId
+    from .storage import get_collection
+    entities = identity_map()
+    if entities: entities.discard(self)
+    
+    collection = get_collection(self.model.__name__)
+    with uncache_after(self.model, [self]):
+      result = collection.delete_one({ '_id': ObjectId(self.id) })
+    return result.deleted_count
 
   def get(self):
     """
@@ -125,11 +162,25 @@ class Key(object):
     ' RETURNS
     '   <MyModel extends Model entity> if entity exists
     '   None if entity does not exist.
-    """
+    ' NOTES
+    '   1. Returns the entity attached by db.prefetch, if any, without
+    '      querying the database.
+    """
+    prefetched = getattr(self, '_prefetched', NOT_PREFETCHED)
+    if prefetched is not NOT_PREFETCHED: return prefetched
+    
+    entities = identity_map()
+    if entities:
+      entity = entities.get(self)
+      if entity: return entity
+    
     try:
-      return self.model(key=self)
+      entity = self.model(key=self)
     except:
       return None
+    
+    if entities: entities.put(entity)
+    return entity
 
   def __repr__(self):
     """
@@ -155,4 +206,6 @@ class Key(object):
 
 
 """ LOCAL IMPORTS (to allow circular imports) """
-from .model import Model
+from .model import Model, ModelMeta
+from .context import identity_map
+from .cache import uncache_after
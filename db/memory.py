@@ -0,0 +1,851 @@
+""" GLOBAL IMPORTS """
+import re
+import threading
+from collections import OrderedDict
+
+
+""" MONGO IMPORTS """
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+
+""" LOCAL IMPORTS """
+from .storage import StorageBackend
+
+
+# stands in for a field a document does not have
+MISSING = object()
+
+
+class MemoryBackend(StorageBackend):
+  """
+  ' PURPOSE
+  '   A storage backend that keeps every collection in memory. It
+  '   answers the same queries and updates the models send to
+  '   MongoDB, so the API, tests and benchmarks can run without a
+  '   mongod. Nothing is persisted.
+  ' EXAMPLE USAGE
+  '   -> db.set_backend(db.MemoryBackend())
+  '   -> UserModel(email='john@doe.com').save()
+  '   -> UserModel.count() # 1
+  """
+
+  def __init__(self):
+    """
+    ' PURPOSE
+    '   Initializes a backend holding no collections.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <MemoryBackend backend>
+    """
+    self._collections = {}
+    self._lock = threading.Lock()
+
+  def collection(self, name):
+    """
+    ' PURPOSE
+    '   Returns the collection that stores the given kind, creating
+    '   an empty one on first use.
+    ' PARAMETERS
+    '   <str name> the collection (model class) name
+    ' RETURNS
+    '   <MemoryCollection collection>
+    """
+    with self._lock:
+      if name not in self._collections:
+        self._collections[name] = MemoryCollection(name)
+      return self._collections[name]
+
+  def clear(self):
+    """
+    ' PURPOSE
+    '   Drops every collection, including their indexes.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   Nothing
+    """
+    with self._lock:
+      self._collections.clear()
+
+
+class MemoryIndex(object):
+  """
+  ' PURPOSE
+  '   A secondary index mapping the values of some fields to the
+  '   identifiers of the documents holding them. Single field indexes
+  '   answer equality and $in lookups, every index can be unique.
+  ' NOTES
+  '   1. Like MongoDB each item of a list value is indexed and a
+  '      missing field is indexed as None.
+  """
+
+  def __init__(self, name, spec, unique=False):
+    """
+    ' PURPOSE
+    '   Initializes an empty index.
+    ' PARAMETERS
+    '   <str name>
+    '   <tuple spec> ( (field, direction), ... )
+    '   optional <bool unique>
+    ' RETURNS
+    '   <MemoryIndex index>
+    """
+    self.name = name
+    self.spec = spec
+    self.names = tuple(field for field, direction in spec)
+    self.unique = unique
+    self.entries = {}
+
+  def keys(self, document):
+    """
+    ' PURPOSE
+    '   Returns the index keys of a document.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   <set keys>
+    """
+    if len(self.names) > 1:
+      return { tuple(hashable(document.get(field)) for field in self.names) }
+    value = document.get(self.names[0])
+    keys = { hashable(value) }
+    if isinstance(value, list):
+      keys.update(hashable(item) for item in value)
+    return keys
+
+  def lookup(self, value):
+    """
+    ' PURPOSE
+    '   Returns the identifiers of the documents holding the given
+    '   value in a single field index.
+    ' PARAMETERS
+    '   <object value>
+    ' RETURNS
+    '   <set ObjectId ids>
+    """
+    return self.entries.get(hashable(value), ())
+
+  def conflict(self, document, ignore=None):
+    """
+    ' PURPOSE
+    '   Returns the key a document would duplicate in this unique
+    '   index, ignoring the document with the given identifier.
+    ' PARAMETERS
+    '   <dict document>
+    '   optional <ObjectId ignore>
+    ' RETURNS
+    '   the duplicated key, or MISSING when there is none
+    """
+    if not self.unique: return MISSING
+    for key in self.keys(document):
+      if self.entries.get(key, set()) - { ignore }:
+        return key
+    return MISSING
+
+  def add(self, document):
+    """
+    ' PURPOSE
+    '   Indexes a document under each of its keys.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   Nothing
+    """
+    for key in self.keys(document):
+      self.entries.setdefault(key, set()).add(document['_id'])
+
+  def remove(self, document):
+    """
+    ' PURPOSE
+    '   Stops indexing a document, dropping the keys no other
+    '   document holds.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   Nothing
+    """
+    for key in self.keys(document):
+      ids = self.entries.get(key)
+      if ids is None: continue
+      ids.discard(document['_id'])
+      if not ids: del self.entries[key]
+
+
+class MemoryCollection(object):
+  """
+  ' PURPOSE
+  '   An in memory stand in for a PyMongo Collection. Implements the
+  '   part of its API the models use. Documents are kept in insertion
+  '   order and are copied in and out so callers never share them.
+  ' NOTES
+  '   1. Supported query operators are $and, $or, $nor, $eq, $ne,
+  '      $lt, $lte, $gt, $gte, $in, $nin and $regex. Supported update
+  '      operators are $set, $unset, $inc, $push and $pull.
+  '   2. Queries with an equality on _id or on a single field index
+  '      only look at the documents the index returns, every other
+  '      query scans the collection.
+  """
+
+  def __init__(self, name):
+    """
+    ' PURPOSE
+    '   Initializes an empty collection with no indexes.
+    ' PARAMETERS
+    '   <str name>
+    ' RETURNS
+    '   <MemoryCollection collection>
+    """
+    self.name = name
+    self._documents = OrderedDict()
+    self._indexes = OrderedDict()
+    self._lock = threading.RLock()
+
+  """ READS """
+
+  def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+    """
+    ' PURPOSE
+    '   Returns a cursor over the documents matching a query, like
+    '   Collection.find.
+    ' PARAMETERS
+    '   optional <dict filter>
+    '   optional <dict projection> { field: 1 }
+    '   optional <list sort> [ (field, direction), ... ]
+    '   optional <int skip>
+    '   optional <int limit> 0 for no limit
+    ' RETURNS
+    '   <MemoryCursor cursor>
+    """
+    with self._lock:
+      documents = self._select(filter or {})
+    return MemoryCursor(documents, projection, sort, skip, limit)
+
+  def find_one(self, filter=None, projection=None, skip=0, **kwargs):
+    """
+    ' PURPOSE
+    '   Returns the first document matching a query, like
+    '   Collection.find_one.
+    ' PARAMETERS
+    '   optional <dict filter> or <ObjectId id>
+    '   optional <dict projection> { field: 1 }
+    '   optional <int skip>
+    ' RETURNS
+    '   <dict document> if one matches
+    '   None otherwise
+    """
+    if filter is not None and not isinstance(filter, dict):
+      filter = { '_id': filter }
+    for document in self.find(filter, projection=projection, skip=skip, limit=1):
+      return document
+    return None
+
+  def count_documents(self, filter, skip=0, limit=0, **kwargs):
+    """
+    ' PURPOSE
+    '   Counts the documents matching a query, like
+    '   Collection.count_documents.
+    ' PARAMETERS
+    '   <dict filter>
+    '   optional <int skip>
+    '   optional <int limit> 0 for no limit
+    ' RETURNS
+    '   <int count>
+    """
+    with self._lock:
+      count = len(self._select(filter)) - skip
+    count = max(count, 0)
+    return min(count, limit) if limit else count
+
+  def index_information(self):
+    """
+    ' PURPOSE
+    '   Describes the collection's indexes, like
+    '   Collection.index_information.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict information> { name: { 'key': [...], ... } }
+    """
+    information = { '_id_': { 'key': [('_id', ASCENDING)] } }
+    for index in self._indexes.values():
+      information[index.name] = { 'key': list(index.spec), 'unique': index.unique }
+    return information
+
+  """ WRITES """
+
+  def insert_one(self, document, **kwargs):
+    """
+    ' PURPOSE
+    '   Inserts a document, giving it an _id if it has none.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   <pymongo.results.InsertOneResult result>
+    ' NOTES
+    '   1. Raises DuplicateKeyError when a unique index is violated.
+    """
+    with self._lock:
+      self._insert(document)
+    return InsertOneResult(document['_id'], True)
+
+  def update_one(self, filter, update, **kwargs):
+    """
+    ' PURPOSE
+    '   Applies update operators to the first document matching a
+    '   query.
+    ' PARAMETERS
+    '   <dict filter>
+    '   <dict update>
+    ' RETURNS
+    '   <pymongo.results.UpdateResult result>
+    """
+    with self._lock:
+      matched = self._update(filter, update) is not None
+    return UpdateResult({ 'n': int(matched), 'nModified': int(matched), 'ok': 1.0 }, True)
+
+  def find_one_and_update(self, filter, update, projection=None, return_document=False, **kwargs):
+    """
+    ' PURPOSE
+    '   Applies update operators to the first document matching a
+    '   query and returns that document.
+    ' PARAMETERS
+    '   <dict filter>
+    '   <dict update>
+    '   optional <dict projection> { field: 1 }
+    '   optional <bool return_document> a pymongo ReturnDocument
+    ' RETURNS
+    '   <dict document> as it was before, or after with ReturnDocument.AFTER
+    '   None if no document matches
+    """
+    with self._lock:
+      documents = self._update(filter, update)
+    if documents is None: return None
+    # ReturnDocument.AFTER is True, ReturnDocument.BEFORE is False
+    return copy_document(documents[1] if return_document else documents[0], projection)
+
+  def delete_one(self, filter, **kwargs):
+    """
+    ' PURPOSE
+    '   Deletes the first document matching a query.
+    ' PARAMETERS
+    '   <dict filter>
+    ' RETURNS
+    '   <pymongo.results.DeleteResult result>
+    """
+    with self._lock:
+      documents = self._select(filter)[:1]
+      for document in documents:
+        self._delete(document)
+    return DeleteResult({ 'n': len(documents), 'ok': 1.0 }, True)
+
+  def bulk_write(self, requests, ordered=True, **kwargs):
+    """
+    ' PURPOSE
+    '   Runs InsertOne, UpdateOne and DeleteOne requests, like
+    '   Collection.bulk_write.
+    ' PARAMETERS
+    '   <list requests>
+    '   optional <bool ordered> stop at the first failed request
+    ' RETURNS
+    '   <pymongo.results.BulkWriteResult result>
+    ' NOTES
+    '   1. Raises BulkWriteError, holding every write error and the
+    '      counts of the writes that were done, if any request failed.
+    """
+    details = {
+      'writeErrors': [],
+      'writeConcernErrors': [],
+      'nInserted': 0,
+      'nUpserted': 0,
+      'nMatched': 0,
+      'nModified': 0,
+      'nRemoved': 0,
+      'upserted': []
+    }
+    with self._lock:
+      for index, request in enumerate(requests):
+        try:
+          # PyMongo keeps the filter and document of each request in
+          # private attributes, there is no public accessor for them
+          if isinstance(request, InsertOne):
+            self._insert(request._doc)
+            details['nInserted'] += 1
+          elif isinstance(request, UpdateOne):
+            if self._update(request._filter, request._doc) is not None:
+              details['nMatched'] += 1
+              details['nModified'] += 1
+          elif isinstance(request, DeleteOne):
+            documents = self._select(request._filter)
+            if documents:
+              self._delete(documents[0])
+              details['nRemoved'] += 1
+          else:
+            raise ValueError('Unsupported bulk write request %r' % (request,))
+        except DuplicateKeyError as error:
+          details['writeErrors'].append({ 'index': index, 'code': error.code, 'errmsg': str(error) })
+          if ordered: break
+
+    if details['writeErrors']:
+      raise BulkWriteError(details)
+    return BulkWriteResult(details, True)
+
+  def create_index(self, keys, unique=False, **kwargs):
+    """
+    ' PURPOSE
+    '   Creates an index over the existing and future documents.
+    '   Creating an index that exists does nothing.
+    ' PARAMETERS
+    '   <str field> or <list keys> [ (field, direction), ... ]
+    '   optional <bool unique>
+    '   optional <str name>
+    ' RETURNS
+    '   <str name> the index name
+    ' NOTES
+    '   1. Raises DuplicateKeyError when a unique index can not be
+    '      created over the existing documents.
+    """
+    if not isinstance(keys, list):
+      keys = [(keys, ASCENDING)]
+    name = kwargs.get('name') or '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+    with self._lock:
+      if name in self._indexes: return name
+      index = MemoryIndex(name, tuple(keys), unique)
+      for document in self._documents.values():
+        key = index.conflict(document)
+        if key is not MISSING:
+          raise DuplicateKeyError('E11000 duplicate key error index: %s dup key: %r' % (name, key), 11000)
+        index.add(document)
+      self._indexes[name] = index
+    return name
+
+  def drop(self):
+    """
+    ' PURPOSE
+    '   Deletes every document and index of the collection.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   Nothing
+    """
+    with self._lock:
+      self._documents.clear()
+      self._indexes.clear()
+
+  """ INTERNALS, CALLED WITH THE LOCK HELD """
+
+  def _select(self, filter):
+    """
+    ' PURPOSE
+    '   A private method used to return the stored documents matching
+    '   a query.
+    ' PARAMETERS
+    '   <dict filter>
+    ' RETURNS
+    '   <list dict documents>
+    """
+    # stored documents are never changed in place, an update stores a
+    # new document, so the returned documents are stable snapshots
+    candidates = self._candidates(filter)
+    filter = prepare(filter)
+    return [document for document in candidates if matches(document, filter)]
+
+  def _candidates(self, filter):
+    """
+    ' PURPOSE
+    '   A private method used to narrow the documents a filter can
+    '   match using the _id key or a single field index, falling back
+    '   to every document.
+    ' PARAMETERS
+    '   <dict filter>
+    ' RETURNS
+    '   <list dict documents>
+    """
+    conditions = [filter] + [part for part in filter.get('$and', []) if isinstance(part, dict)]
+    for condition in conditions:
+      for field, value in condition.items():
+        if field.startswith('$'): continue
+        values = equalities(value)
+        if values is None: continue
+        if field == '_id':
+          return [self._documents[id] for id in unique_values(values) if hashable(id) in self._documents]
+        for index in self._indexes.values():
+          if index.names == (field,):
+            ids = set()
+            for item in values: ids.update(index.lookup(item))
+            return [self._documents[id] for id in ids]
+    return list(self._documents.values())
+
+  def _insert(self, document):
+    """
+    ' PURPOSE
+    '   A private method used to store a copy of a new document and
+    '   index it.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   Nothing
+    """
+    if '_id' not in document:
+      # like PyMongo the caller's document is given its _id
+      document['_id'] = ObjectId()
+    document = copy_document(document)
+    self._check_unique(document)
+    self._documents[document['_id']] = document
+    for index in self._indexes.values():
+      index.add(document)
+
+  def _update(self, filter, update):
+    """
+    ' PURPOSE
+    '   A private method used to replace the first document matching
+    '   a query with its updated copy.
+    ' PARAMETERS
+    '   <dict filter>
+    '   <dict update>
+    ' RETURNS
+    '   <tuple (before, after)> if a document matched
+    '   None otherwise
+    """
+    documents = self._select(filter)
+    if not documents: return None
+
+    before = documents[0]
+    after = apply_update(copy_document(before), update)
+    self._check_unique(after, ignore=before['_id'])
+    for index in self._indexes.values():
+      index.remove(before)
+      index.add(after)
+    self._documents[after['_id']] = after
+    return before, after
+
+  def _delete(self, document):
+    """
+    ' PURPOSE
+    '   A private method used to drop a stored document and its index
+    '   keys.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   Nothing
+    """
+    del self._documents[document['_id']]
+    for index in self._indexes.values():
+      index.remove(document)
+
+  def _check_unique(self, document, ignore=None):
+    """
+    ' PURPOSE
+    '   A private method used to raise DuplicateKeyError when a
+    '   document would duplicate an _id or a unique index key.
+    ' PARAMETERS
+    '   <dict document>
+    '   optional <ObjectId ignore> the document being replaced
+    ' RETURNS
+    '   Nothing
+    """
+    if ignore is None and document['_id'] in self._documents:
+      raise DuplicateKeyError('E11000 duplicate key error index: _id_ dup key: %r' % (document['_id'],), 11000)
+    for index in self._indexes.values():
+      key = index.conflict(document, ignore)
+      if key is not MISSING:
+        raise DuplicateKeyError('E11000 duplicate key error index: %s dup key: %r' % (index.name, key), 11000)
+
+
+class MemoryCursor(object):
+  """
+  ' PURPOSE
+  '   The result of MemoryCollection.find. Sorting, skipping and
+  '   limiting happen up front, documents are copied as they are
+  '   iterated.
+  """
+
+  def __init__(self, documents, projection=None, sort=None, skip=0, limit=0):
+    """
+    ' PURPOSE
+    '   Initializes a cursor, sorting, skipping and limiting the
+    '   matched documents.
+    ' PARAMETERS
+    '   <list dict documents>
+    '   optional <dict projection> { field: 1 }
+    '   optional <list sort> [ (field, direction), ... ]
+    '   optional <int skip>
+    '   optional <int limit> 0 for no limit
+    ' RETURNS
+    '   <MemoryCursor cursor>
+    """
+    for field, direction in reversed(sort or []):
+      documents.sort(key=lambda document: sort_key(document.get(field)), reverse=direction < 0)
+    documents = documents[skip:]
+    if limit: documents = documents[:abs(limit)]
+    self._documents = documents
+    self._projection = projection
+
+  def batch_size(self, batch_size):
+    """
+    ' PURPOSE
+    '   Accepted like Cursor.batch_size, documents are already in
+    '   memory so it changes nothing.
+    ' PARAMETERS
+    '   <int batch_size>
+    ' RETURNS
+    '   <MemoryCursor cursor>
+    """
+    return self
+
+  def __iter__(self):
+    """
+    ' PURPOSE
+    '   Yields a copy of each document, projected.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <generator dict>
+    """
+    for document in self._documents:
+      yield copy_document(document, self._projection)
+
+
+""" DOCUMENT HELPERS """
+
+def copy_document(document, projection=None):
+  """
+  ' PURPOSE
+  '   Copies a document, keeping only the projected fields and _id
+  '   when an inclusion projection is given.
+  ' PARAMETERS
+  '   <dict document>
+  '   optional <dict projection> { field: 1 }
+  ' RETURNS
+  '   <dict document>
+  """
+  if projection:
+    fields = [field for field, include in projection.items() if include]
+    if projection.get('_id', 1): fields.append('_id')
+    pairs = ((field, document[field]) for field in fields if field in document)
+  else:
+    pairs = document.items()
+  return dict((field, list(value) if isinstance(value, list) else value) for field, value in pairs)
+
+
+def hashable(value):
+  """
+  ' PURPOSE
+  '   Returns a value that can be held in a set or used as a dict
+  '   key, turning lists and dicts into tuples.
+  ' PARAMETERS
+  '   <object value>
+  ' RETURNS
+  '   <object hashable>
+  """
+  if isinstance(value, list):
+    return tuple(hashable(item) for item in value)
+  if isinstance(value, dict):
+    return tuple(sorted((key, hashable(item)) for key, item in value.items()))
+  return value
+
+
+def unique_values(values):
+  """
+  ' PURPOSE
+  '   Yields the given values in order, skipping repeated ones.
+  ' PARAMETERS
+  '   <iterable values>
+  ' RETURNS
+  '   <generator object>
+  """
+  seen = set()
+  for value in values:
+    if hashable(value) in seen: continue
+    seen.add(hashable(value))
+    yield value
+
+
+def equalities(condition):
+  """
+  ' PURPOSE
+  '   Returns the values a field condition requires equality with.
+  ' PARAMETERS
+  '   <object condition>
+  ' RETURNS
+  '   <list values> for a plain, $eq or $in condition
+  '   None otherwise
+  """
+  if not is_operator_document(condition):
+    return [condition]
+  if set(condition) - { '$eq', '$in' }:
+    return None
+  if '$in' in condition and '$eq' in condition:
+    return [value for value in condition['$in'] if value == condition['$eq']]
+  if '$in' in condition:
+    return list(condition['$in'])
+  return [condition['$eq']]
+
+
+def is_operator_document(condition):
+  """
+  ' PURPOSE
+  '   Checks whether a field condition is made of query operators,
+  '   e.g. { '$gt': 1 }, rather than a value to equal.
+  ' PARAMETERS
+  '   <object condition>
+  ' RETURNS
+  '   True if every key is an operator
+  '   False otherwise
+  """
+  return isinstance(condition, dict) and bool(condition) and all(key.startswith('$') for key in condition)
+
+
+def sort_key(value):
+  """
+  ' PURPOSE
+  '   Returns the key a field value sorts by.
+  ' PARAMETERS
+  '   <object value>
+  ' RETURNS
+  '   <tuple key>
+  """
+  # missing fields and None sort before every other value
+  if value is None: return (0, 0)
+  return (1, value)
+
+
+""" QUERY MATCHING """
+
+def prepare(filter):
+  """
+  ' PURPOSE
+  '   Returns a copy of a query whose $in and $nin lists are turned
+  '   into sets, so matching a document is not linear in their size.
+  ' PARAMETERS
+  '   <dict filter>
+  ' RETURNS
+  '   <dict filter>
+  """
+  if isinstance(filter, list):
+    return [prepare(part) for part in filter]
+  if not isinstance(filter, dict):
+    return filter
+  prepared = {}
+  for key, value in filter.items():
+    if key in ('$in', '$nin'):
+      value = frozenset(hashable(item) for item in value)
+    prepared[key] = prepare(value)
+  return prepared
+
+
+COMPARISONS = {
+  '$lt': lambda value, operand: value < operand,
+  '$lte': lambda value, operand: value <= operand,
+  '$gt': lambda value, operand: value > operand,
+  '$gte': lambda value, operand: value >= operand
+}
+
+
+def matches(document, filter):
+  """
+  ' PURPOSE
+  '   Checks whether a document matches a MongoDB query.
+  ' PARAMETERS
+  '   <dict document>
+  '   <dict filter>
+  ' RETURNS
+  '   True if the document matches
+  '   False if it does not
+  """
+  for field, condition in filter.items():
+    if field == '$and':
+      if not all(matches(document, part) for part in condition): return False
+    elif field == '$or':
+      if not any(matches(document, part) for part in condition): return False
+    elif field == '$nor':
+      if any(matches(document, part) for part in condition): return False
+    elif field.startswith('$'):
+      raise ValueError('Unsupported query operator %s' % field)
+    elif is_operator_document(condition):
+      value = document.get(field, MISSING)
+      for operator, operand in condition.items():
+        if not matches_operator(value, operator, operand): return False
+    elif not matches_operator(document.get(field, MISSING), '$eq', condition):
+      return False
+  return True
+
+
+def matches_operator(value, operator, operand):
+  """
+  ' PURPOSE
+  '   Checks whether a field value satisfies one query operator.
+  ' PARAMETERS
+  '   <object value> MISSING when the document lacks the field
+  '   <str operator> e.g. '$eq'
+  '   <object operand>
+  ' RETURNS
+  '   True if it does
+  '   False if it does not
+  """
+  if operator == '$ne':
+    return not matches_operator(value, '$eq', operand)
+  if operator == '$nin':
+    return not matches_operator(value, '$in', operand)
+
+  # a missing field equals None, and a query on a list field matches
+  # when the whole list or any one of its items does
+  if value is MISSING: value = None
+  candidates = [value] + (value if isinstance(value, list) else [])
+
+  if operator == '$eq':
+    return any(candidate == operand for candidate in candidates)
+  if operator == '$regex':
+    return any(isinstance(candidate, str) and re.search(operand, candidate) is not None for candidate in candidates)
+  if operator == '$in':
+    if isinstance(operand, frozenset):
+      return any(hashable(candidate) in operand for candidate in candidates)
+    return any(candidate == item for candidate in candidates for item in operand)
+  if operator in COMPARISONS:
+    if operand is None:
+      return operator in ('$lte', '$gte') and value is None
+    compare = COMPARISONS[operator]
+    for candidate in candidates:
+      if candidate is None: continue
+      try:
+        if compare(candidate, operand): return True
+      except TypeError:
+        # like MongoDB, values of different types never compare
+        continue
+    return False
+  raise ValueError('Unsupported query operator %s' % operator)
+
+
+""" UPDATES """
+
+def apply_update(document, update):
+  """
+  ' PURPOSE
+  '   Applies MongoDB update operators to a document in place.
+  ' PARAMETERS
+  '   <dict document>
+  '   <dict update>
+  ' RETURNS
+  '   <dict document>
+  """
+  for operator, fields in update.items():
+    for field, value in fields.items():
+      if field == '_id':
+        raise ValueError('The _id of a document can not be updated')
+      if operator == '$set':
+        document[field] = list(value) if isinstance(value, list) else value
+      elif operator == '$unset':
+        document.pop(field, None)
+      elif operator == '$inc':
+        document[field] = document.get(field, 0) + value
+      elif operator == '$push':
+        document[field] = document.get(field, []) + [value]
+      elif operator == '$pull':
+        if field in document:
+          document[field] = [item for item in document[field] if item != value]
+      else:
+        raise ValueError('Unsupported update operator %s' % operator)
+  return document
@@ -1,21 +1,85 @@
+""" GLOBAL IMPORTS """
+from collections import OrderedDict
+from types import MappingProxyType
+
+
 """ LOCAL IMPORTS """
-from .properties import Property, PropertyQuery
+from .properties import Property, PropertyQuery, FloatProperty
 from .key import Key
-from . import query
+from .errors import MultiWriteError, DuplicateKeyError, PartialEntityError, ConcurrentModificationError
+from .context import identity_map
+from .cache import entity_cache, uncache_after
+from .rows import make_row_type
+from .serializers import compile_serializers
+from .storage import get_collection
+from . import aio, query
 
 
 """ MONGO IMPORTS """
-from pymongo import MongoClient
+from pymongo import InsertOne, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError as MongoDuplicateKeyError
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 
 
-""" MONGO DATABASE """
-mongo = MongoClient('localhost', 27017)
-rawdb = mongo.develop_database
+class ModelMeta(type):
+  """
+  ' PURPOSE
+  '   The metaclass of every Model. Compiles a model's properties
+  '   once when the class is created so that entity construction,
+  '   packing, and query building are table lookups instead of
+  '   walking the class attributes on every call.
+  ' NOTES
+  '   1. Every model class receives...
+  '      _schema        <tuple (str name, Property prop)> in declaration
+  '                     order, inherited properties first
+  '      _property_map  <mappingproxy str name -> Property prop>
+  '      Row            <class Row> its compact, unsaveable row type
+  '      _serialize     <function> its compiled entity serializer
+  '      _serialize_document <function> its compiled raw document serializer
+  '   2. Every property receives its attribute name as prop.name
+  '   3. Every model is registered by name in ModelMeta.models
+  """
+
+  # model name -> model class, see Key.get_model
+  models = {}
+
+  @classmethod
+  def __prepare__(mcs, name, bases, **kwargs):
+    """
+    ' PURPOSE
+    '   Keeps the class body in declaration order.
+    """
+    return OrderedDict()
+
+  def __new__(mcs, name, bases, namespace, **kwargs):
+    """
+    ' PURPOSE
+    '   Creates the model class and compiles its schema.
+    """
+    cls = super(ModelMeta, mcs).__new__(mcs, name, bases, dict(namespace))
+    
+    schema = OrderedDict()
+    for base in reversed(cls.__mro__[1:]):
+      for attr, prop in getattr(base, '_schema', ()):
+        schema[attr] = prop
+    for attr, value in namespace.items():
+      if isinstance(value, Property):
+        value.name = attr
+        schema[attr] = value
+    
+    cls._schema = tuple(schema.items())
+    cls._property_map = MappingProxyType(dict(schema))
+    serialize_entity, serialize_row, serialize_document = compile_serializers(cls)
+    cls._serialize = staticmethod(serialize_entity)
+    cls._serialize_document = staticmethod(serialize_document)
+    cls.Row = make_row_type(cls, serialize_row)
+    if bases != (object,):
+      ModelMeta.models[name] = cls
+    return cls
 
 
-class Model(object):
+class Model(object, metaclass=ModelMeta):
   """
   ' PURPOSE
   '   The Model class is the superclass to all other database
@@ -49,8 +113,35 @@ class Model(object):
   '   and an age '18 < age < 25'
   '
   '   -> matches = User.fetch(User.fullname == 'Jane Doe', User.age < 25, User.age > 18, count=10)
+  '
+  '   Models that are read far more often than they are written can
+  '   opt into the process wide entity cache.
+  '
+  '   -> class User(db.Model):
+  '   ->   __cache__ = True
+  '
+  '   Counters and lists can be changed atomically without loading
+  '   the entity first.
+  '
+  '   -> User.increment(user.key, User.logins)
+  '   -> User.push(user.key, User.tags, 'traveler')
+  '
+  '   Versioned models refuse to save an entity that someone else
+  '   saved since it was loaded (optimistic concurrency).
+  '
+  '   -> class User(db.Model):
+  '   ->   __versioned__ = True
   """
   
+  """ CONSTANTS """
+  # whether documents of this model are held in db.entity_cache
+  __cache__ = False
+  # compound indexes created by db.ensure_indexes, see db.Index
+  __indexes__ = []
+  # whether saves check and bump a version field, raising
+  # db.ConcurrentModificationError when the entity changed meanwhile
+  __versioned__ = False
+  
   @classmethod
   def delete_all(cls):
     """
@@ -61,14 +152,23 @@ class Model(object):
     ' RETURNS
     '   <int deleted> the count of entities deleted
     """
-    collection = getattr(rawdb, cls.__name__)
-    deleted = collection.count()
-    collection.drop()
+    entities = identity_map()
+    if entities: entities.discard_kind(cls)
+    
+    collection = get_collection(cls.__name__)
+    try:
+      deleted = collection.count_documents({})
+      collection.drop()
+    finally:
+      # purged once the drop is done, like uncache_after
+      if cls.__cache__:
+        prefix = '%s:' % cls.__name__
+        entity_cache.purge(lambda serial, document: serial.startswith(prefix))
     return deleted
   
   # count = 0 means no limit
   @classmethod
-  def fetch(cls, *args, count=0, keys_only=False):
+  def fetch(cls, *args, count=0, keys_only=False, sort=None, start_after=None, offset=0, projection=None, compact=False, raw=False, include=None):
     """
     ' PURPOSE
     '   Fetches entities from this model using the provided
@@ -85,6 +185,8 @@ class Model(object):
     '   ->
     '   -> matches = User.fetch(User.email == 'john@doe.com', User.age < 25)
     '
+    '   Use query instead to iterate lazily over large results.
+    '
     ' PARAMETERS
     '   <PropertyQuery prop_query1>
     '   <PropertyQuery prop_query2>
@@ -95,25 +197,200 @@ class Model(object):
     '                        matching the fiters.
     '   optional <bool keys_only> If true, returns the keys of matching
     '                             entities instead of the model instances.
+    '   optional <list sort> The properties to order by, each either a
+    '                        property or a (property, db.DESCENDING) tuple.
+    '                        Ties are broken by newest first.
+    '   optional <Key start_after> Only return entities saved before the
+    '                              entity of this key (or identifier). Used
+    '                              to page through the default order.
+    '   optional <int offset> The amount of matching entities to skip.
+    '   optional <list Property projection> If given, only these properties
+    '                                       are loaded and the returned
+    '                                       entities are read-only.
+    '   optional <bool compact> If true, returns compact, unsaveable rows
+    '                           instead of entities, see db.Row.
+    '   optional <bool raw> If true, returns plain dicts instead of
+    '                       entities, see fetch_dicts.
+    '   optional <list KeyProperty include> The referenced entities of
+    '                                       these properties are loaded
+    '                                       along, see db.prefetch.
     ' RETURNS
-    '   <list MyModel extends db.Model> if not keys_only
+    '   <list MyModel extends db.Model> if not keys_only, compact, nor raw
     '   <list db.Key> if keys_only
+    '   <list MyModel.Row> if compact
+    '   <list dict> if raw
+    ' NOTES
+    '   1. Entities are returned newest first unless sorted otherwise.
+    '   2. start_after pages by key (keyset pagination) and hence can
+    '      not be combined with sort.
     """
-    # TODO change to a smart generator. Allowing indexed gets
-    # but will simply iterate to the index to get it.
-    bson = query.AND(*args).bson(cls)
-    
-    collection = getattr(rawdb, cls.__name__)
-    cursor = collection.find(bson, limit=count, projection={ '_id':1 })
+    q = cls._fetch_query(args, count, sort, start_after, offset, projection)
+    return q.fetch(keys_only=keys_only, compact=compact, raw=raw, include=include)
+  
+  @classmethod
+  def afetch(cls, *args, **kwargs):
+    """
+    ' PURPOSE
+    '   Asynchronous fetch, takes the same arguments and runs the
+    '   query on the db thread pool.
+    ' RETURNS
+    '   <awaitable list> of what fetch would return
+    """
+    return aio.run(cls.fetch, *args, **kwargs)
+  
+  @classmethod
+  def fetch_dicts(cls, *args, count=0, sort=None, start_after=None, offset=0, projection=None):
+    """
+    ' PURPOSE
+    '   Lazily fetches the matching documents as plain dicts, ready to
+    '   be serialized, without building entities. Takes the same
+    '   parameters as fetch.
+    '
+    '   -> for trip in Trip.fetch_dicts(projection=[Trip.name, Trip.author]):
+    '   ->   print(trip) # { 'id': '...', 'name': '...', 'author': '<user id>' }
+    '
+    ' PARAMETERS
+    '   *see fetch*
+    ' RETURNS
+    '   <generator dict>
+    ' NOTES
+    '   1. Each dict is serialized like Model.to_dict, holding the entity's
+    '      'id' and its (projected) public properties, keys as identifiers.
+    """
+    q = cls._fetch_query(args, count, sort, start_after, offset, projection)
+    return q.iter(raw=True)
+  
+  @classmethod
+  def _fetch_query(cls, args, count, sort, start_after, offset, projection):
+    """
+    ' PURPOSE
+    '   A private method used to turn the parameters of fetch into a Query.
+    ' PARAMETERS
+    '   *see fetch*
+    ' RETURNS
+    '   <db.Query query>
+    """
+    q = cls.query(*args).limit(count).offset(offset)
+    if sort:
+      q = q.order(*(sort if isinstance(sort, list) else [sort]))
+    if start_after:
+      q = q.start_after(start_after)
+    if projection:
+      q = q.project(*projection)
+    return q
+  
+  @classmethod
+  def get_dict_by_id(cls, id, projection=None):
+    """
+    ' PURPOSE
+    '   Returns the document associated with the given identifier as
+    '   a plain dict, see fetch_dicts. Served from the entity cache when
+    '   the model opted in.
+    ' PARAMETERS
+    '   <str id>
+    '   optional <list Property projection>
+    ' RETURNS
+    '   <dict document> if entity exists
+    '   None if entity does not exist
+    """
+    try:
+      objectid = ObjectId(id)
+    except (InvalidId, TypeError):
+      return None
     
-    documents = []
+    names = [prop.name for prop in projection or []]
+    serial = cls.key_from_id(id).serialize()
+    document = cls.__cache__ and entity_cache.get(serial)
+    if not document:
+      generation = entity_cache.generation()
+      fields = dict((name, 1) for name in names) or None
+      collection = get_collection(cls.__name__)
+      document = collection.find_one({ '_id': objectid }, projection=fields)
+      if not document: return None
+      if cls.__cache__ and not names: entity_cache.set(serial, document, generation)
+    elif names:
+      projected = dict((name, document[name]) for name in names if name in document)
+      projected['_id'] = document['_id']
+      document = projected
     
-    for document in cursor:
-      if keys_only: documents.append(Key(cls, str(document['_id'])))
-      else: documents.append(cls(id=str(document['_id'])))
-      
-    documents.reverse()
-    return documents
+    return cls._serialize_document(document)
+  
+  @classmethod
+  def query(cls, *args):
+    """
+    ' PURPOSE
+    '   Returns a lazy, chainable query over this model's entities
+    '   using the provided filters. See db.Query for details.
+    '
+    '   -> for user in User.query(User.age < 25).order(User.age).iter(batch_size=500):
+    '   ->   print(user.email)
+    '
+    ' PARAMETERS
+    '   <PropertyQuery prop_query1>
+    '   ...
+    '   <PropertyQuery prop_queryN>
+    ' RETURNS
+    '   <db.Query query>
+    """
+    return query.Query(cls, *args)
+  
+  @classmethod
+  def count(cls, *args):
+    """
+    ' PURPOSE
+    '   Counts the entities matching the provided filters on the
+    '   database server, no entity is loaded.
+    '
+    '   -> trips = Trip.count(Trip.author == user.key)
+    '
+    ' PARAMETERS
+    '   <PropertyQuery prop_query1>
+    '   ...
+    '   <PropertyQuery prop_queryN>
+    ' RETURNS
+    '   <int count>
+    """
+    return cls.query(*args).count()
+  
+  @classmethod
+  def exists(cls, *args):
+    """
+    ' PURPOSE
+    '   Checks whether any entity matches the provided filters, no
+    '   entity is loaded.
+    '
+    '   -> taken = User.exists(User.email == 'john@doe.com')
+    '
+    ' PARAMETERS
+    '   <PropertyQuery prop_query1>
+    '   ...
+    '   <PropertyQuery prop_queryN>
+    ' RETURNS
+    '   True if any entity matches
+    '   False if no entity matches
+    """
+    return cls.query(*args).exists()
+  
+  @classmethod
+  def _hydrate(cls, document, partial=False):
+    """
+    ' PURPOSE
+    '   A private method used to turn a queried document into an entity,
+    '   reusing the instance held by the identity map if there is one.
+    ' PARAMETERS
+    '   <dict document>
+    '   optional <bool partial> whether the document was projected
+    ' RETURNS
+    '   <MyModel extends Model entity>
+    ' NOTES
+    '   1. Partial entities are never held by the identity map.
+    """
+    entities = identity_map()
+    entity = entities and entities.get(cls.key_from_id(str(document['_id'])))
+    if not entity:
+      entity = cls.from_document(document, partial=partial)
+      if entities and not partial: entities.put(entity)
+    return entity
   
   @classmethod
   def key_from_id(cls, id):
@@ -141,6 +418,377 @@ class Model(object):
     """
     return cls.key_from_id(id).get()
   
+  @classmethod
+  def aget_by_id(cls, id):
+    """
+    ' PURPOSE
+    '   Asynchronous get_by_id, the lookup runs on the db thread pool.
+    ' PARAMETERS
+    '   <str identifier>
+    ' RETURNS
+    '   <awaitable MyModel extends db.Model entity or None>
+    ' EXAMPLE USAGE
+    '   -> user, trip = await asyncio.gather(
+    '   ->   UserModel.aget_by_id(user_id), TripModel.aget_by_id(trip_id))
+    """
+    return aio.run(cls.get_by_id, id)
+  
+  @classmethod
+  def aget_multi(cls, keys):
+    """
+    ' PURPOSE
+    '   Asynchronous get_multi, the lookup runs on the db thread pool.
+    ' PARAMETERS
+    '   <list Key keys>
+    ' RETURNS
+    '   <awaitable list MyModel extends db.Model entity or None>
+    """
+    return aio.run(cls.get_multi, keys)
+  
+  @classmethod
+  def from_document(cls, document, partial=False):
+    """
+    ' PURPOSE
+    '   Builds an entity straight from a raw database document
+    '   without querying the database again.
+    ' PARAMETERS
+    '   <dict document> a raw document, including its '_id'
+    '   optional <bool partial> whether the document only holds some
+    '                           of the entity's properties
+    ' RETURNS
+    '   <MyModel extends Model entity>
+    ' NOTES
+    '   1. Partial entities are read-only, saving them raises
+    '      db.PartialEntityError.
+    """
+    entity = cls()
+    entity.key = cls.key_from_id(str(document['_id']))
+    entity.kind = cls.__name__
+    entity._partial = partial
+    entity._unpack(document)
+    return entity
+  
+  @classmethod
+  def get_by_ids(cls, ids):
+    """
+    ' PURPOSE
+    '   Returns the entities associated with the given identifiers
+    '   using a single query.
+    ' PARAMETERS
+    '   <list str ids>
+    ' RETURNS
+    '   <list MyModel extends db.Model entity or None> in the same
+    '   order as the provided identifiers
+    """
+    return cls.get_multi([cls.key_from_id(id) for id in ids])
+  
+  @staticmethod
+  def get_multi(keys):
+    """
+    ' PURPOSE
+    '   Returns the entities associated with the given keys. Keys
+    '   may belong to different models, one query is issued per
+    '   model kind.
+    ' PARAMETERS
+    '   <list Key keys>
+    ' RETURNS
+    '   <list MyModel extends db.Model entity or None> in the same
+    '   order as the provided keys
+    ' NOTES
+    '   1. Missing entities and malformed identifiers yield None.
+    """
+    entities = identity_map()
+    found = {}
+    
+    kinds = {}
+    for key in keys:
+      entity = entities and entities.get(key)
+      if entity:
+        found[key.serialize()] = entity
+        continue
+      document = key.model.__cache__ and entity_cache.get(key.serialize())
+      if document:
+        entity = key.model.from_document(document)
+        found[key.serialize()] = entity
+        if entities: entities.put(entity)
+        continue
+      try:
+        objectid = ObjectId(key.id)
+      except (InvalidId, TypeError):
+        continue
+      kinds.setdefault(key.model, []).append(objectid)
+    
+    for model, objectids in kinds.items():
+      generation = entity_cache.generation()
+      collection = get_collection(model.__name__)
+      for document in collection.find({ '_id': { '$in': objectids } }):
+        entity = model.from_document(document)
+        found[entity.key.serialize()] = entity
+        if entities: entities.put(entity)
+        if model.__cache__: entity_cache.set(entity.key.serialize(), document, generation)
+    
+    return [found.get(key.serialize()) for key in keys]
+  
+  @staticmethod
+  def put_multi(entities):
+    """
+    ' PURPOSE
+    '   Saves many entities at once. Writes are grouped by model
+    '   kind and sent as one unordered bulk write per kind.
+    ' PARAMETERS
+    '   <list MyModel extends db.Model entities>
+    ' RETURNS
+    '   <list MyModel extends db.Model entities>
+    ' NOTES
+    '   1. New entities are given their keys once the writes are done.
+    '      Existing entities only write the properties that changed.
+    '   2. If any write fails a MultiWriteError is raised after every
+    '      other write has been applied. Its errors list is aligned
+    '      with the given entities.
+    '   3. Raises db.PartialEntityError before writing anything if any
+    '      entity was loaded with a projection.
+    '   4. Updates of versioned models are sent one by one, entities that
+    '      were modified since they were loaded are reported as errors.
+    """
+    kinds = {}
+    for index, entity in enumerate(entities):
+      if entity._partial:
+        raise PartialEntityError('Partial entities can not be saved')
+      kinds.setdefault(entity.__class__, []).append(index)
+    
+    errors = [None] * len(entities)
+    for model, indexes in kinds.items():
+      operations = []
+      written = []
+      versioned = []
+      inserted = {}
+      for index in indexes:
+        entity = entities[index]
+        if entity.key == None:
+          document = entity._packed_new()
+          document['_id'] = ObjectId()
+          inserted[index] = document['_id']
+          operations.append(InsertOne(document))
+        else:
+          changes = entity._changes()
+          if not changes: continue
+          if model.__versioned__:
+            # bulk results can't tell which versioned update missed
+            versioned.append(index)
+            continue
+          operations.append(UpdateOne(entity._selector(), changes))
+        written.append(index)
+      
+      collection = get_collection(model.__name__)
+      if operations:
+        try:
+          collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as error:
+          for write_error in error.details['writeErrors']:
+            errors[written[write_error['index']]] = write_error['errmsg']
+      
+      for index in versioned:
+        entity = entities[index]
+        try:
+          result = collection.update_one(entity._selector(), entity._changes())
+          if result.matched_count == 0:
+            errors[index] = 'Entity was modified since it was loaded'
+        except MongoDuplicateKeyError as error:
+          errors[index] = str(error)
+        written.append(index)
+      
+      for index in written:
+        if errors[index]: continue
+        entity = entities[index]
+        if index in inserted:
+          entity.key = Key(model, str(inserted[index]))
+          entity.kind = model.__name__
+          entity._cache()
+        else:
+          if model.__cache__: entity_cache.discard(entity.key.serialize())
+          if model.__versioned__: entity._version = (entity._version or 0) + 1
+        entity._dirty.clear()
+    
+    identities = identity_map()
+    if identities:
+      for index, entity in enumerate(entities):
+        if not errors[index]: identities.put(entity)
+    
+    if any(errors):
+      raise MultiWriteError(errors)
+    return entities
+  
+  @staticmethod
+  def delete_multi(keys):
+    """
+    ' PURPOSE
+    '   Deletes the entities associated with many keys at once
+    '   using one unordered bulk write per model kind.
+    ' PARAMETERS
+    '   <list Key keys>
+    ' RETURNS
+    '   <int deleted> the number of deleted entities
+    ' NOTES
+    '   1. If any delete fails a MultiWriteError is raised after every
+    '      other delete has been applied. Its errors list is aligned
+    '      with the given keys.
+    '   2. Keys with a malformed identifier are reported as errors,
+    '      they can not match any entity.
+    """
+    entities = identity_map()
+    kinds = {}
+    objectids = {}
+    errors = [None] * len(keys)
+    for index, key in enumerate(keys):
+      try:
+        objectids[index] = ObjectId(key.id)
+      except (InvalidId, TypeError):
+        errors[index] = 'Malformed identifier %r' % (key.id,)
+        continue
+      kinds.setdefault(key.model, []).append(index)
+      if entities: entities.discard(key)
+    
+    deleted = 0
+    for model, indexes in kinds.items():
+      operations = [DeleteOne({ '_id': objectids[index] }) for index in indexes]
+      collection = get_collection(model.__name__)
+      try:
+        with uncache_after(model, [keys[index] for index in indexes]):
+          deleted += collection.bulk_write(operations, ordered=False).deleted_count
+      except BulkWriteError as error:
+        deleted += error.details['nRemoved']
+        for write_error in error.details['writeErrors']:
+          errors[indexes[write_error['index']]] = write_error['errmsg']
+    
+    if any(errors):
+      raise MultiWriteError(errors)
+    return deleted
+  
+  @classmethod
+  def increment(cls, key, prop, n=1):
+    """
+    ' PURPOSE
+    '   Atomically adds n to a numeric property of the entity of the
+    '   given key, without loading it.
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    '   <Property prop> an IntegerProperty or FloatProperty
+    '   optional <int n> or <float n>
+    ' RETURNS
+    '   <int value> or <float value> the property's new value
+    '   None if the entity does not exist
+    ' NOTES
+    '   1. An int n is added to a FloatProperty as a float.
+    """
+    if isinstance(n, bool) or not isinstance(n, (int, float)):
+      raise ValueError('increment takes an int or float n, not %r' % (n,))
+    if isinstance(prop, FloatProperty): n = float(n)
+    attr = prop.name
+    document = cls._atomic_update(key, {
+      '$inc': { attr: prop.pack(n) }
+    }, returning=attr)
+    if not document: return None
+    return prop.unpack(document.get(attr))
+  
+  @classmethod
+  def push(cls, key, prop, value):
+    """
+    ' PURPOSE
+    '   Atomically appends a value to a ListProperty of the entity
+    '   of the given key, without loading it.
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    '   <ListProperty prop>
+    '   <object value>
+    ' RETURNS
+    '   True if the entity exists
+    '   False if the entity does not exist
+    """
+    attr = prop.name
+    result = cls._atomic_update(key, {
+      '$push': { attr: prop.pack_item(value) }
+    })
+    return result.matched_count > 0
+  
+  @classmethod
+  def pull(cls, key, prop, value):
+    """
+    ' PURPOSE
+    '   Atomically removes every occurence of a value from a
+    '   ListProperty of the entity of the given key, without loading it.
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    '   <ListProperty prop>
+    '   <object value>
+    ' RETURNS
+    '   True if the entity exists
+    '   False if the entity does not exist
+    """
+    attr = prop.name
+    result = cls._atomic_update(key, {
+      '$pull': { attr: prop.pack_item(value) }
+    })
+    return result.matched_count > 0
+  
+  @classmethod
+  def compare_and_set(cls, key, prop, expected, value):
+    """
+    ' PURPOSE
+    '   Atomically sets a property of the entity of the given key
+    '   only if it currently holds the expected value.
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    '   <Property prop>
+    '   <object expected>
+    '   <object value>
+    ' RETURNS
+    '   True if the property held the expected value and was set
+    '   False otherwise
+    """
+    attr = prop.name
+    packed = prop.pack(value)
+    if packed == None: update = { '$unset': { attr: '' } }
+    else: update = { '$set': { attr: packed } }
+    result = cls._atomic_update(key, update, { attr: prop.pack(expected) })
+    return result.matched_count > 0
+  
+  @classmethod
+  def _atomic_update(cls, key, update, conditions=None, returning=None):
+    """
+    ' PURPOSE
+    '   A private method used to apply an update operator document to
+    '   the entity of the given key in a single conditional write.
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    '   <dict update> mongo update operators
+    '   optional <dict conditions> further conditions on the document
+    '   optional <str returning> when given, the updated document is
+    '                            returned holding only this field
+    ' RETURNS
+    '   <pymongo.results.UpdateResult result> if not returning
+    '   <dict document> or None if returning
+    ' NOTES
+    '   1. The entity is dropped from the identity map and, once the
+    '      write is done, from the entity cache since their copies can
+    '      no longer be trusted.
+    """
+    if not isinstance(key, Key):
+      key = cls.key_from_id(key)
+    if cls.__versioned__:
+      update.setdefault('$inc', {})['_version'] = 1
+    
+    entities = identity_map()
+    if entities: entities.discard(key)
+    
+    selector = { '_id': ObjectId(key.id) }
+    selector.update(conditions or {})
+    collection = get_collection(cls.__name__)
+    with uncache_after(cls, [key]):
+      if returning:
+        return collection.find_one_and_update(selector, update,
+          projection={ returning: 1 }, return_document=ReturnDocument.AFTER)
+      return collection.update_one(selector, update)
+  
   @classmethod
   def get_properties(cls):
     """
@@ -156,12 +804,7 @@ class Model(object):
     '      while the second item is the actual PropertyClass, for example
     '      StringProperty or FloatProperty.
     """
-    properties = []
-    for attr in vars(cls):
-      val = getattr(cls, attr)
-      if isinstance(val, Property):
-        properties.append((attr, val.__class__))
-    return properties
+    return [(attr, prop.__class__) for attr, prop in cls._schema]
   
   def __init__(self, key=None, id=None, **kwargs):
     """
@@ -185,12 +828,13 @@ class Model(object):
     '      Now this entity will be initialized with the properties for 'prop1'
     '      and 'float1' already filled in.
     """
-    self._properties = []
-    for attr in vars(self.__class__):
-      val = getattr(self.__class__, attr)
-      if isinstance(val, Property):
-        self._properties.append(attr)
-        setattr(self, attr, None)
+    self._partial = False
+    # version of the saved document, only used by versioned models
+    self._version = None
+    # property -> value, see Property.__get__ and Property.__set__
+    self._values = {}
+    # properties assigned since the entity was last loaded or saved
+    self._dirty = set()
     
     if key:
       self.key = key
@@ -205,9 +849,25 @@ class Model(object):
       self.kind = self.__class__.__name__
     
     for prop, value in kwargs.items():
-      if prop in self._properties:
+      if prop in self._property_map:
         setattr(self, prop, value)
   
+  def to_dict(self):
+    """
+    ' PURPOSE
+    '   Returns the public dict of this entity. Holds its 'id' and every
+    '   property not declared private, under its public_name if it has
+    '   one, with keys converted to identifiers.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict data>
+    ' NOTES
+    '   1. The serializer is compiled once per model from its schema,
+    '      see db.serializers.
+    """
+    return self._serialize(self)
+  
   def packed(self, meta=False):
     """
     ' PURPOSE
@@ -220,9 +880,9 @@ class Model(object):
     '   <dict data>
     """
     json = {}
-    for attr in self._properties:
-      packer = getattr(self.__class__, attr)
-      json[attr] = packer.pack(getattr(self, attr))
+    values = self._values
+    for attr, packer in self._schema:
+      json[attr] = packer.pack(values.get(packer))
     if meta:
       json['key'] = self.key.serialize()
       json['id'] = self.key.id
@@ -240,16 +900,103 @@ class Model(object):
     """
     if not self.key: return
     
-    collection = getattr(rawdb, self.__class__.__name__)
-    entity = collection.find_one({'_id': ObjectId(self.key.id)})
+    serial = self.key.serialize()
+    entity = self.__cache__ and entity_cache.get(serial)
     if not entity:
-      raise ValueError('Entity does not exist')
+      generation = entity_cache.generation()
+      collection = get_collection(self.__class__.__name__)
+      entity = collection.find_one({'_id': ObjectId(self.key.id)})
+      if not entity:
+        raise ValueError('Entity does not exist')
+      if self.__cache__: entity_cache.set(serial, entity, generation)
     
-    reserved = ['_id']
-    for key, value in entity.items():
-      if not key in reserved:
-        packer = getattr(self.__class__, key)
-        setattr(self, key, packer.unpack(value))
+    self._unpack(entity)
+  
+  def _cache(self):
+    """
+    ' PURPOSE
+    '   A private method used to write this entity's saved data
+    '   through to the entity cache when its model opted in.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   None
+    """
+    if not self.__cache__: return
+    document = self.packed()
+    document['_id'] = ObjectId(self.key.id)
+    if self.__versioned__: document['_version'] = self._version
+    entity_cache.set(self.key.serialize(), document)
+  
+  def _unpack(self, document):
+    """
+    ' PURPOSE
+    '   A private method used to copy the values of a raw database
+    '   document onto this entity.
+    ' PARAMETERS
+    '   <dict document>
+    ' RETURNS
+    '   None
+    """
+    properties = self._property_map
+    for key, value in document.items():
+      packer = properties.get(key)
+      if packer: self._values[packer] = packer.unpack(value)
+    self._version = document.get('_version')
+  
+  def _changes(self):
+    """
+    ' PURPOSE
+    '   A private method used to build the update document holding
+    '   only the properties assigned since the last load or save.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict update> with $set and/or $unset, empty if nothing changed
+    ' NOTES
+    '   1. Properties set to None are removed from the document, they
+    '      load as None again.
+    """
+    changes = {}
+    for packer in self._dirty:
+      value = packer.pack(self._values.get(packer))
+      if value == None:
+        changes.setdefault('$unset', {})[packer.name] = ''
+      else:
+        changes.setdefault('$set', {})[packer.name] = value
+    if changes and self.__versioned__:
+      changes['$inc'] = { '_version': 1 }
+    return changes
+  
+  def _selector(self):
+    """
+    ' PURPOSE
+    '   A private method used to build the filter matching this entity's
+    '   document, including its version for versioned models.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict selector>
+    """
+    selector = { '_id': ObjectId(self.key.id) }
+    if self.__versioned__: selector['_version'] = self._version
+    return selector
+  
+  def _packed_new(self):
+    """
+    ' PURPOSE
+    '   A private method used to build the document inserted for a new
+    '   entity, including its first version for versioned models.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict document>
+    """
+    document = self.packed()
+    if self.__versioned__:
+      self._version = 1
+      document['_version'] = 1
+    return document
   
   def save(self):
     """
@@ -262,21 +1009,57 @@ class Model(object):
     ' NOTES
     '   1. New entities have no key value until this method
     '      has been executed successfuly.
+    '   2. Raises db.DuplicateKeyError if a unique index is broken.
+    '   3. Raises db.PartialEntityError if the entity was loaded with
+    '      a projection.
+    '   4. Existing entities only write the properties assigned since
+    '      they were loaded or saved, nothing is written if none were.
+    '   5. Raises db.ConcurrentModificationError if the model is versioned
+    '      and the entity was saved by someone else since it was loaded.
     """
-    collection = getattr(rawdb, self.__class__.__name__)
-    if self.key == None:
-      # create new database entry
-      saved = collection.insert_one(self.packed())
-      id = saved.inserted_id
-      self.key = Key(self.__class__, id)
-      self.kind = self.key.model.__name__
-    else:
-      # update database entry
-      collection.replace_one({
-        '_id': ObjectId(self.key.id)
-      }, self.packed())
+    if self._partial:
+      raise PartialEntityError('Partial entities can not be saved')
+    
+    collection = get_collection(self.__class__.__name__)
+    try:
+      if self.key == None:
+        # create new database entry
+        saved = collection.insert_one(self._packed_new())
+        id = saved.inserted_id
+        self.key = Key(self.__class__, str(id))
+        self.kind = self.key.model.__name__
+        self._cache()
+      else:
+        # update the changed fields of the database entry
+        changes = self._changes()
+        if changes:
+          with uncache_after(self.__class__, [self.key]):
+            result = collection.update_one(self._selector(), changes)
+          if self.__versioned__:
+            if result.matched_count == 0:
+              raise ConcurrentModificationError('Entity was modified since it was loaded')
+            self._version = (self._version or 0) + 1
+    except MongoDuplicateKeyError as error:
+      raise DuplicateKeyError(str(error))
+    
+    self._dirty.clear()
+    entities = identity_map()
+    if entities: entities.put(self)
     return self
   
+  def asave(self):
+    """
+    ' PURPOSE
+    '   Asynchronous save, the write runs on the db thread pool.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <awaitable MyModel extends db.Model entity>
+    ' NOTES
+    '   1. The entity must not be changed until the write is done.
+    """
+    return aio.run(self.save)
+  
   def delete(self):
     """
     ' PURPOSE
@@ -287,3 +1070,14 @@ class Model(object):
     '   Nothing
     """
     self.key.delete()
+  
+  def adelete(self):
+    """
+    ' PURPOSE
+    '   Asynchronous delete, the write runs on the db thread pool.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <awaitable>
+    """
+    return aio.run(self.delete)
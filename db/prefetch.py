@@ -0,0 +1,46 @@
+""" LOCAL IMPORTS """
+from .key import Key
+
+
+def prefetch(entities, *props):
+  """
+  ' PURPOSE
+  '   Loads the entities referenced by the given KeyProperty values of
+  '   many entities at once and attaches them to their keys, so that
+  '   later key.get() calls need no query. Every referenced key is
+  '   resolved with a single Key.get_multi, one query per kind.
+  ' PARAMETERS
+  '   <list MyModel extends Model or MyModel.Row entities>
+  '   <KeyProperty prop1>
+  '   ...
+  '   <KeyProperty propN>
+  ' RETURNS
+  '   <list entities> the given entities
+  ' EXAMPLE USAGE
+  '   -> trips = db.prefetch(TripModel.fetch(), TripModel.author)
+  '   -> [trip.author.get().email for trip in trips] # no further queries
+  ' NOTES
+  '   1. Lists of keys (ListProperty(item=KeyProperty())) are resolved
+  '      item by item.
+  '   2. A referenced entity that does not exist is attached as None.
+  '   3. Attached entities are not refreshed, prefetch again for fresh
+  '      copies.
+  """
+  keys = []
+  for entity in entities:
+    if entity is None: continue
+    for prop in props:
+      value = getattr(entity, prop.name, None)
+      for key in value if isinstance(value, list) else [value]:
+        if isinstance(key, Key): keys.append(key)
+
+  # each referenced entity is loaded once however often it is referenced
+  unique = {}
+  for key in keys:
+    unique.setdefault(key.serialize(), key)
+  serials = list(unique)
+  found = dict(zip(serials, Key.get_multi([unique[serial] for serial in serials])))
+
+  for key in keys:
+    key._prefetched = found[key.serialize()]
+  return entities
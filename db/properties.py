@@ -1,3 +1,7 @@
+""" LOCAL IMPORTS """
+from .errors import PartialEntityError
+
+
 class PropertyQuery(object):
   """
   ' PURPOSE
@@ -34,8 +38,80 @@ class Property(object):
   '   It's function is to dictate how to pack values in order
   '   to store their value in a JSON document as well as to dictate
   '   how to unpack the same data.
+  '
+  '   Properties are also descriptors, an entity's values are held
+  '   in its _values dict and every assignment marks the property
+  '   as dirty so that saves only write what changed.
+  '
+  ' EXAMPLE USAGE
+  '   Properties that are often filtered on should be indexed, see
+  '   db.ensure_indexes.
+  '
+  '   -> email = db.StringProperty(unique=True)
+  '   -> author = db.KeyProperty(indexed=True)
+  '
+  '   Properties are serialized by Model.to_dict unless private,
+  '   and may be serialized under another name.
+  '
+  '   -> password = db.ByteStringProperty(private=True)
+  '   -> author = db.KeyProperty(public_name='author_id')
   """
 
+  def __init__(self, indexed=False, unique=False, private=False, public_name=None):
+    """
+    ' PURPOSE
+    '   Initializes the property with its index and serialization options.
+    ' PARAMETERS
+    '   optional <bool indexed> whether to index this property
+    '   optional <bool unique> whether to index this property and
+    '                          require its values to be unique
+    '   optional <bool private> whether to leave this property out of
+    '                           serialized dicts
+    '   optional <str public_name> the name to serialize this property
+    '                              under, defaults to its attribute name
+    ' RETURNS
+    '   <Property prop>
+    """
+    self.indexed = indexed
+    self.unique = unique
+    self.private = private
+    self.public_name = public_name
+    # the attribute name, set by the model's metaclass
+    self.name = None
+
+  def __get__(self, instance, owner):
+    """
+    ' PURPOSE
+    '   Returns the entity's value for this property. When accessed
+    '   on the model class itself returns the property, which allows
+    '   building queries such as User.age < 25.
+    ' PARAMETERS
+    '   <Model instance> or None
+    '   <class MyModel extends Model owner>
+    ' RETURNS
+    '   <object value> if accessed on an entity
+    '   <Property prop> if accessed on the model class
+    """
+    if instance == None: return self
+    return instance._values.get(self)
+
+  def __set__(self, instance, value):
+    """
+    ' PURPOSE
+    '   Sets the entity's value for this property and marks it dirty.
+    ' PARAMETERS
+    '   <Model instance>
+    '   <object value>
+    ' RETURNS
+    '   Nothing
+    ' NOTES
+    '   1. Raises db.PartialEntityError on partial entities.
+    """
+    if instance._partial:
+      raise PartialEntityError('Partial entities are read-only')
+    instance._values[self] = value
+    instance._dirty.add(self)
+
   def unpack(self, value):
     """
     ' PURPOSE
@@ -58,6 +134,30 @@ class Property(object):
     """
     raise ValueError('All properties must be a subclass of Property and have overridden pack')
 
+  def export(self, value):
+    """
+    ' PURPOSE
+    '   Converts a packed value straight into its public form, without
+    '   unpacking it first. Used by raw (dict) queries.
+    ' PARAMETERS
+    '   <object value> packed value
+    ' RETURNS
+    '   <object value> public value
+    """
+    return value
+
+  def public(self, value):
+    """
+    ' PURPOSE
+    '   Converts an unpacked value into its public, JSON safe form.
+    '   Used by Model.to_dict.
+    ' PARAMETERS
+    '   <object value> unpacked value
+    ' RETURNS
+    '   <object value> public value
+    """
+    return value
+
   def __hash__(self):
     """
     ' PURPOSE
@@ -185,6 +285,10 @@ class ByteStringProperty(Property):
       raise ValueError('ByteStringProperty must contain bytes instance')
     return value.decode('utf-8')
 
+  def public(self, value):
+    if value == None: return None
+    return value.decode('utf-8')
+
 
 class IntegerProperty(Property):
   def unpack(self, value):
@@ -210,6 +314,48 @@ class FloatProperty(Property):
     return value
 
 
+class ListProperty(Property):
+  """
+  ' PURPOSE
+  '   Holds a list of values, each packed by the optional item
+  '   property. See Model.push and Model.pull to atomically add to
+  '   and remove from it.
+  ' EXAMPLE USAGE
+  '   -> tags = db.ListProperty(db.StringProperty())
+  ' NOTES
+  '   1. Changing the list in place is not tracked, assign a new list
+  '      for the change to be saved.
+  """
+
+  def __init__(self, item=None, **kwargs):
+    super(ListProperty, self).__init__(**kwargs)
+    self.item = item
+
+  def unpack(self, value):
+    if value == None: return None
+    if not self.item: return list(value)
+    return [self.item.unpack(item) for item in value]
+
+  def pack(self, value):
+    if value == None: return None
+    if not isinstance(value, list):
+      raise ValueError('ListProperty must contain list instance')
+    if not self.item: return list(value)
+    return [self.item.pack(item) for item in value]
+
+  def pack_item(self, value):
+    if not self.item: return value
+    return self.item.pack(value)
+
+  def export(self, value):
+    if value == None or not self.item: return value
+    return [self.item.export(item) for item in value]
+
+  def public(self, value):
+    if value == None or not self.item: return value
+    return [self.item.public(item) for item in value]
+
+
 class KeyProperty(Property):
   def unpack(self, value):
     if value == None: return None
@@ -222,3 +368,12 @@ class KeyProperty(Property):
     if not isinstance(value, Key):
       raise ValueError('KeyProperty must contain Key instance')
     return value.serialize()
+
+  def export(self, value):
+    # 'Model:id' -> 'id'
+    if value == None: return None
+    return value[value.index(':') + 1:]
+
+  def public(self, value):
+    if value == None: return None
+    return value.id
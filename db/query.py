@@ -1,5 +1,37 @@
+""" GLOBAL IMPORTS """
+import re
+
+
 """ LOCAL IMPORTS """
-from .properties import Property
+from .cache import LRUCache
+from .properties import ListProperty, PropertyQuery
+
+
+""" MONGO IMPORTS """
+from pymongo import ASCENDING, DESCENDING
+
+
+def sort_spec(modelcls, sort):
+  """
+  ' PURPOSE
+  '   Given a Model subclass and a sort order, convert the order into
+  '   a PyMongo compatible sort specification.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  '   <list Property prop or (Property prop, int direction)>
+  '     where direction is db.ASCENDING or db.DESCENDING, a single
+  '     item may also be given without the list
+  ' RETURNS
+  '   <list (str name, int direction)>
+  """
+  if not sort: return []
+  if not isinstance(sort, list): sort = [sort]
+  
+  spec = []
+  for order in sort:
+    prop, direction = order if isinstance(order, tuple) else (order, ASCENDING)
+    spec.append((prop.name, direction))
+  return spec
 
 
 class AND(object):
@@ -10,24 +42,25 @@ class AND(object):
   ' EXAMPLE USAGE
   '   -> db.AND(User.email == 'john@doe.com', User.age < 25)
   """
-  
+
+  operator = '$and'
+
   def __init__(self, *partialqueries):
     """
     ' PURPOSE
     '   Initializes the AND with given property queries.
     ' PARAMETERS
-    '   <PropertyQuery propquery1>
-    '   <PropertyQuery propquery2>
+    '   <PropertyQuery propquery1> or <AND, OR, NOT filter1>
+    '   <PropertyQuery propquery2> or <AND, OR, NOT filter2>
     '   ...
-    '   <PropertyQuery propqueryN>
+    '   <PropertyQuery propqueryN> or <AND, OR, NOT filterN>
     ' RETURNS
     '   <AND and>
     """
     self._bson = None
     self._partialqueries = partialqueries
-  
+
   def bson(self, modelcls):
-    # TODO make each property aware of it's name
     """
     ' PURPOSE
     '   Given a Model subclass class. Convert the property queries
@@ -38,27 +71,650 @@ class AND(object):
     ' RETURNS
     '   <dict bson>
     ' NOTES
-    '   1. Caches the result (memoize)
+    '   1. Caches the result (memoize), the compiled shape of the
+    '      query is also cached per model, see compile_filter.
     """
     if not self._partialqueries: return {}
     if self._bson: return self._bson
+
+    self._bson = compile_filter(modelcls, self).build(filter_values(self))
+    return self._bson
+
+
+class OR(AND):
+  """
+  ' PURPOSE
+  '   Matches entities matching any of the given property queries.
+  ' EXAMPLE USAGE
+  '   -> db.OR(User.age < 18, User.age > 65)
+  '   -> db.AND(User.fullname == 'Jane Doe', db.OR(User.age < 18, User.age > 65))
+  """
+
+  operator = '$or'
+
+
+class NOT(object):
+  """
+  ' PURPOSE
+  '   Matches entities not matching the given property query.
+  ' EXAMPLE USAGE
+  '   -> db.NOT(db.PREFIX(User.email, 'test'))
+  '   -> db.NOT(db.OR(User.age < 18, User.age > 65))
+  """
+
+  operator = '$not'
+
+  def __init__(self, partialquery):
+    """
+    ' PURPOSE
+    '   Initializes the NOT with the negated property query.
+    ' PARAMETERS
+    '   <PropertyQuery propquery> or <AND, OR, NOT filter>
+    ' RETURNS
+    '   <NOT not>
+    """
+    self._partialqueries = (partialquery,)
+
+
+def IN(prop, values):
+  """
+  ' PURPOSE
+  '   Matches entities whose property equals any of the given values.
+  ' PARAMETERS
+  '   <Property prop>
+  '   <list values>
+  ' RETURNS
+  '   <PropertyQuery propquery>
+  ' EXAMPLE USAGE
+  '   -> Trip.fetch(db.IN(Trip.author, [key1, key2]))
+  """
+  return PropertyQuery(prop, list(values), '$in')
+
+
+def NOT_IN(prop, values):
+  """
+  ' PURPOSE
+  '   Matches entities whose property equals none of the given values.
+  ' PARAMETERS
+  '   <Property prop>
+  '   <list values>
+  ' RETURNS
+  '   <PropertyQuery propquery>
+  """
+  return PropertyQuery(prop, list(values), '$nin')
+
+
+def PREFIX(prop, prefix):
+  """
+  ' PURPOSE
+  '   Matches entities whose string property starts with the given
+  '   prefix. Prefix queries can use an index on the property.
+  ' PARAMETERS
+  '   <StringProperty prop>
+  '   <str prefix>
+  ' RETURNS
+  '   <PropertyQuery propquery>
+  ' EXAMPLE USAGE
+  '   -> Trip.fetch(db.PREFIX(Trip.name, 'Paris'))
+  """
+  return PropertyQuery(prop, prefix, '$regex')
+
+
+""" QUERY COMPILER """
+# operators an index can be used for, the rest need a scan of whatever
+# the indexable operators left
+INDEXABLE_OPERATORS = frozenset(['$eq', '$in', '$lt', '$lte', '$gt', '$gte', '$regex'])
+
+# compiled filters by (model class, shape), see compile_filter
+compiled_filters = LRUCache(maxsize=512)
+
+
+def filter_shape(node):
+  """
+  ' PURPOSE
+  '   Returns the shape of a filter, its structure, properties and
+  '   operators without the compared values. Filters differing only
+  '   in their values share a shape and hence a compiled query.
+  ' PARAMETERS
+  '   <PropertyQuery propquery> or <AND, OR, NOT filter>
+  ' RETURNS
+  '   <tuple shape>
+  """
+  if isinstance(node, PropertyQuery):
+    return (node.operator, node.property.name)
+  return (node.operator,) + tuple(filter_shape(child) for child in node._partialqueries)
+
+
+def filter_values(node, values=None):
+  """
+  ' PURPOSE
+  '   Returns the compared values of a filter in the order
+  '   its compiled query expects them.
+  ' PARAMETERS
+  '   <PropertyQuery propquery> or <AND, OR, NOT filter>
+  ' RETURNS
+  '   <list values>
+  """
+  if values is None: values = []
+  if isinstance(node, PropertyQuery):
+    values.append(node.value)
+  else:
+    for child in node._partialqueries:
+      filter_values(child, values)
+  return values
+
+
+class CompiledFilter(object):
+  """
+  ' PURPOSE
+  '   A filter shape compiled for one model. Builds the BSON query of
+  '   any filter of its shape from the filter's values, and reports
+  '   the declared index it expects MongoDB to use.
+  ' EXAMPLE USAGE
+  '   -> compiled = compile_filter(Trip, AND(Trip.author == key))
+  '   -> compiled.build([key])   # { '$and': [{ 'author': { '$eq': ... } }] }
+  '   -> compiled.index.names    # ('author',)
+  """
+
+  def __init__(self, modelcls, shape):
+    """
+    ' PURPOSE
+    '   Compiles a filter shape.
+    ' PARAMETERS
+    '   <class MyModel extends Model>
+    '   <tuple shape> see filter_shape
+    ' RETURNS
+    '   <CompiledFilter compiled>
+    """
+    from .indexes import expected_index
+    self.shape = shape
+    self._builder = self._compile(modelcls, shape)
+    # only the top level conjunction can be served by a single index
+    fields = []
+    if shape[0] == '$and':
+      for child in shape[1:]:
+        if child[0] in INDEXABLE_OPERATORS and child[1] not in fields:
+          fields.append(child[1])
+    self.fields = tuple(fields)
+    self.index = expected_index(modelcls, self.fields)
+
+  def build(self, values):
+    """
+    ' PURPOSE
+    '   Builds the BSON query of a filter of this shape.
+    ' PARAMETERS
+    '   <list values> see filter_values
+    ' RETURNS
+    '   <dict bson>
+    """
+    return self._builder(iter(values))
+
+  def _compile(self, modelcls, shape):
+    operator = shape[0]
+    if operator in ('$and', '$or'):
+      children = [self._compile(modelcls, child) for child in shape[1:]]
+      return lambda values: { operator: [child(values) for child in children] }
+    if operator == '$not':
+      # $not only applies to a single field, $nor negates any query
+      child = self._compile(modelcls, shape[1])
+      return lambda values: { '$nor': [child(values)] }
+
+    name = shape[1]
+    prop = modelcls._property_map.get(name)
+    if prop is None:
+      raise ValueError('%s has no property %s' % (modelcls.__name__, name))
+    if isinstance(prop, ListProperty):
+      # a list field is compared with single items as well as whole lists
+      pack_one = lambda value: prop.pack(value) if isinstance(value, list) else prop.pack_item(value)
+    else:
+      pack_one = prop.pack
+    if operator in ('$in', '$nin'):
+      pack = lambda value: [pack_one(item) for item in value]
+    elif operator == '$regex':
+      pack = lambda value: '^' + re.escape(pack_one(value))
+    else:
+      pack = pack_one
+    return lambda values: { name: { operator: pack(next(values)) } }
+
+
+def compile_filter(modelcls, node):
+  """
+  ' PURPOSE
+  '   Returns the compiled query of a filter's shape for a model,
+  '   compiling it only the first time the shape is seen.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  '   <AND, OR, NOT filter>
+  ' RETURNS
+  '   <CompiledFilter compiled>
+  ' NOTES
+  '   1. Compiled shapes are kept in the bounded compiled_filters
+  '      cache, see compiled_filters.stats() for its hit rate.
+  """
+  shape = filter_shape(node)
+  # keyed by the class, a model redefined under the same name has
+  # other properties and hence needs its own compiled filters
+  cache_key = (modelcls, shape)
+  compiled = compiled_filters.get(cache_key)
+  if compiled is None:
+    compiled = CompiledFilter(modelcls, shape)
+    compiled_filters.set(cache_key, compiled)
+  return compiled
+
+
+class Query(object):
+  """
+  ' PURPOSE
+  '   A lazy, chainable query over the entities of one model.
+  '   Nothing is read from the database until the query is
+  '   iterated, and iterating pulls documents from the database
+  '   cursor in batches instead of building the whole result list.
+  ' EXAMPLE USAGE
+  '   Every chained method returns a new query, leaving the
+  '   original one untouched.
+  '
+  '   -> adults = User.query(User.age >= 18)
+  '   -> youngest = adults.order(User.age).first()
+  '   -> for user in adults.filter(User.fullname == 'Jane Doe').iter(batch_size=500):
+  '   ->   print(user.email)
+  '   -> second_page = adults.order((User.age, db.DESCENDING))[10:20]
+  """
+
+  def __init__(self, modelcls, *partialqueries):
+    """
+    ' PURPOSE
+    '   Initializes the query with a model and its filters.
+    ' PARAMETERS
+    '   <class MyModel extends Model>
+    '   <PropertyQuery propquery1>
+    '   ...
+    '   <PropertyQuery propqueryN>
+    ' RETURNS
+    '   <Query query>
+    """
+    self._model = modelcls
+    self._partialqueries = partialqueries
+    self._order = ()
+    self._limit = 0
+    self._offset = 0
+    self._start_after = None
+    self._end_at = None
+    self._projection = ()
+
+  def _clone(self, **changes):
+    """
+    ' PURPOSE
+    '   A private method used to copy this query with some of its
+    '   private attributes changed.
+    ' PARAMETERS
+    '   **changes attribute names (without the underscore) and values
+    ' RETURNS
+    '   <Query query>
+    """
+    clone = Query(self._model, *self._partialqueries)
+    clone._order = self._order
+    clone._limit = self._limit
+    clone._offset = self._offset
+    clone._start_after = self._start_after
+    clone._end_at = self._end_at
+    clone._projection = self._projection
+    for attr, value in changes.items():
+      setattr(clone, '_' + attr, value)
+    return clone
+
+  def filter(self, *partialqueries):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query with additional filters.
+    ' PARAMETERS
+    '   <PropertyQuery propquery1>
+    '   ...
+    '   <PropertyQuery propqueryN>
+    ' RETURNS
+    '   <Query query>
+    """
+    return self._clone(partialqueries=self._partialqueries + partialqueries)
+
+  def order(self, *orders):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query ordered by the given properties.
+    '   Ties are always broken newest first.
+    ' PARAMETERS
+    '   <Property prop1> or <(Property prop1, int direction)>
+    '   ...
+    '   <Property propN> or <(Property propN, int direction)>
+    ' RETURNS
+    '   <Query query>
+    """
+    return self._clone(order=self._order + orders)
+
+  def limit(self, count):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query returning at most count entities.
+    ' PARAMETERS
+    '   <int count> 0 means no limit
+    ' RETURNS
+    '   <Query query>
+    """
+    return self._clone(limit=count)
+
+  def offset(self, count):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query skipping the first count entities.
+    ' PARAMETERS
+    '   <int count>
+    ' RETURNS
+    '   <Query query>
+    """
+    return self._clone(offset=count)
+
+  def start_after(self, key):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query only matching entities saved
+    '   before the entity of the given key (keyset pagination).
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    ' RETURNS
+    '   <Query query>
+    ' NOTES
+    '   1. Can not be combined with order.
+    """
+    return self._clone(start_after=key)
+
+  def end_at(self, key):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query only matching entities saved at
+    '   or after the entity of the given key, e.g. the last entity of
+    '   a page whose cursor was read ahead of it.
+    ' PARAMETERS
+    '   <Key key> or <str id>
+    ' RETURNS
+    '   <Query query>
+    ' NOTES
+    '   1. Can not be combined with order.
+    """
+    return self._clone(end_at=key)
+
+  def project(self, *props):
+    """
+    ' PURPOSE
+    '   Returns a copy of this query only loading the given properties.
+    '   The entities it returns are partial and hence read-only.
+    ' PARAMETERS
+    '   <Property prop1>
+    '   ...
+    '   <Property propN>
+    ' RETURNS
+    '   <Query query>
+    """
+    return self._clone(projection=self._projection + props)
+
+  def bson(self):
+    """
+    ' PURPOSE
+    '   Returns this query's filters as a PyMongo compatible BSON query.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict bson>
+    """
+    from .model import Key, ObjectId
+    bson = AND(*self._partialqueries).bson(self._model)
+    if not self._start_after and not self._end_at: return bson
     
-    attr_map = {}
-    
-    for attr in vars(modelcls):
-      val = getattr(modelcls, attr)
-      if isinstance(val, Property):
-        attr_map[val] = attr
-    
-    self._bson = { '$and': [] }
-    and_query = self._bson['$and']
-    
-    for partialquery in self._partialqueries:
-      and_query.append({
-        attr_map[partialquery.property]: {
-          partialquery.operator: partialquery.property.pack(partialquery.value)
-        }
-      })
+    if self._order:
+      raise ValueError('start_after and end_at can not be combined with order')
+    bounds = {}
+    for operator, key in (('$lt', self._start_after), ('$gte', self._end_at)):
+      if not key: continue
+      if not isinstance(key, Key):
+        key = self._model.key_from_id(key)
+      bounds[operator] = ObjectId(key.id)
+    between = { '_id': bounds }
+    return { '$and': [bson, between] } if bson else between
+
+  def expected_index(self):
+    """
+    ' PURPOSE
+    '   Returns the declared index this query's filters are expected
+    '   to use, see CompiledFilter.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <Index index> if a declared index serves the filters
+    '   None if the query would scan the collection
+    """
+    if not self._partialqueries: return None
+    return compile_filter(self._model, AND(*self._partialqueries)).index
+
+  def _cursor(self, projection=None, batch_size=0):
+    """
+    ' PURPOSE
+    '   A private method used to open a database cursor for this query.
+    ' PARAMETERS
+    '   optional <dict projection>
+    '   optional <int batch_size> documents per round trip, 0 for the default
+    ' RETURNS
+    '   <pymongo.cursor.Cursor cursor>
+    """
+    from .storage import get_collection
+    order = sort_spec(self._model, list(self._order)) + [('_id', DESCENDING)]
+    collection = get_collection(self._model.__name__)
+    cursor = collection.find(
+      self.bson(),
+      projection=projection,
+      sort=order,
+      skip=self._offset,
+      limit=self._limit)
+    if batch_size: cursor.batch_size(batch_size)
+    return cursor
+
+  def iter(self, batch_size=0, keys_only=False, compact=False, raw=False):
+    """
+    ' PURPOSE
+    '   Lazily iterates over the matching entities, pulling them from
+    '   the database batch_size documents at a time.
+    ' PARAMETERS
+    '   optional <int batch_size> documents per round trip, 0 for the default
+    '   optional <bool keys_only> If true, yields the keys of matching
+    '                             entities instead of the model instances.
+    '   optional <bool compact> If true, yields compact, unsaveable rows
+    '                           instead of entities, see db.Row.
+    '   optional <bool raw> If true, yields plain dicts serialized like
+    '                       Model.to_dict, no entity is built.
+    ' RETURNS
+    '   <generator MyModel extends Model> if not keys_only, compact, nor raw
+    '   <generator Key> if keys_only
+    '   <generator MyModel.Row> if compact
+    '   <generator dict> if raw
+    """
+    if keys_only:
+      for document in self._cursor(projection={ '_id': 1 }, batch_size=batch_size):
+        yield self._model.key_from_id(str(document['_id']))
+    elif raw:
+      serialize = self._model._serialize_document
+      props = self._projection or [prop for attr, prop in self._model._schema if not prop.private]
+      projection = dict((prop.name, 1) for prop in props)
+      for document in self._cursor(projection=projection, batch_size=batch_size):
+        yield serialize(document)
+    elif compact:
+      row_type, key_from_id = self._model.Row, self._model.key_from_id
+      projection = dict((prop.name, 1) for prop in self._projection) or None
+      for document in self._cursor(projection=projection, batch_size=batch_size):
+        yield row_type.from_document(document, key_from_id(str(document['_id'])))
+    elif self._projection:
+      projection = dict((prop.name, 1) for prop in self._projection)
+      for document in self._cursor(projection=projection, batch_size=batch_size):
+        yield self._model._hydrate(document, partial=True)
+    else:
+      for document in self._cursor(batch_size=batch_size):
+        yield self._model._hydrate(document)
+
+  def __iter__(self):
+    """
+    ' PURPOSE
+    '   Lazily iterates over the matching entities.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <generator MyModel extends Model>
+    """
+    return self.iter()
+
+  def __aiter__(self):
+    """
+    ' PURPOSE
+    '   Asynchronously iterates over the matching entities, they are
+    '   read on the db thread pool 100 at a time.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <db.aio.AsyncIterator MyModel extends Model>
+    ' EXAMPLE USAGE
+    '   -> async for trip in TripModel.query(TripModel.author == key):
+    '   ->   print(trip.name)
+    """
+    return self.aiter()
+
+  def aiter(self, batch_size=100, keys_only=False, compact=False, raw=False):
+    """
+    ' PURPOSE
+    '   Asynchronous iter, takes the same options.
+    ' PARAMETERS
+    '   optional <int batch_size> entities read per trip to the thread pool
+    '   optional <bool keys_only>
+    '   optional <bool compact>
+    '   optional <bool raw>
+    ' RETURNS
+    '   <db.aio.AsyncIterator>
+    """
+    from .aio import AsyncIterator
+    iterable = self.iter(batch_size=batch_size, keys_only=keys_only, compact=compact, raw=raw)
+    return AsyncIterator(iterable, batch_size=batch_size)
+
+  def fetch(self, keys_only=False, compact=False, raw=False, include=None):
+    """
+    ' PURPOSE
+    '   Returns every matching entity as a list.
+    ' PARAMETERS
+    '   optional <bool keys_only>
+    '   optional <bool compact>
+    '   optional <bool raw>
+    '   optional <list KeyProperty include> properties whose referenced
+    '                                       entities are loaded along,
+    '                                       see db.prefetch
+    ' RETURNS
+    '   <list MyModel extends Model> if not keys_only, compact, nor raw
+    '   <list Key> if keys_only
+    '   <list MyModel.Row> if compact
+    '   <list dict> if raw
+    """
+    if include and (keys_only or raw):
+      raise ValueError('include can not be combined with keys_only or raw')
+    results = list(self.iter(keys_only=keys_only, compact=compact, raw=raw))
+    if include:
+      from .prefetch import prefetch
+      prefetch(results, *include)
+    return results
+
+  def afetch(self, keys_only=False, compact=False, raw=False, include=None):
+    """
+    ' PURPOSE
+    '   Asynchronous fetch, the query runs on the db thread pool.
+    ' RETURNS
+    '   <awaitable list> of what fetch would return
+    """
+    from .aio import run
+    return run(self.fetch, keys_only=keys_only, compact=compact, raw=raw, include=include)
+
+  def first(self):
+    """
+    ' PURPOSE
+    '   Returns the first matching entity.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <MyModel extends Model entity> if any entity matches
+    '   None if no entity matches
+    """
+    for entity in self.limit(1):
+      return entity
+    return None
+
+  def count(self):
+    """
+    ' PURPOSE
+    '   Counts the matching entities on the database server without
+    '   loading them.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <int count>
+    """
+    from .storage import get_collection
+    options = {}
+    if self._offset: options['skip'] = self._offset
+    if self._limit: options['limit'] = self._limit
+    collection = get_collection(self._model.__name__)
+    return collection.count_documents(self.bson(), **options)
+
+  def exists(self):
+    """
+    ' PURPOSE
+    '   Checks whether any entity matches without loading it, only
+    '   the identifier of the first match is read.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   True if any entity matches
+    '   False if no entity matches
+    """
+    from .storage import get_collection
+    collection = get_collection(self._model.__name__)
+    return collection.find_one(self.bson(), projection={ '_id': 1 }, skip=self._offset) != None
+
+  def __getitem__(self, index):
+    """
+    ' PURPOSE
+    '   Returns the matching entity at an index, or a list of the
+    '   matching entities within a slice. Only the requested entities
+    '   are read from the database.
+    ' PARAMETERS
+    '   <int index> or <slice indexes>
+    ' RETURNS
+    '   <MyModel extends Model entity> if given an index
+    '   <list MyModel extends Model> if given a slice
+    ' NOTES
+    '   1. Negative indexes and slice steps are not supported.
+    """
+    if isinstance(index, slice):
+      if index.step not in (None, 1):
+        raise ValueError('Query slices do not support steps')
+      start, stop = index.start or 0, index.stop
+      if start < 0 or (stop != None and stop < 0):
+        raise ValueError('Query slices do not support negative indexes')
+      if stop != None and stop <= start: return []
+      query = self.offset(self._offset + start)
+      if stop != None:
+        count = stop - start
+        if self._limit: count = min(count, max(0, self._limit - start))
+        if not count: return []
+        query = query.limit(count)
+      elif self._limit:
+        if self._limit <= start: return []
+        query = query.limit(self._limit - start)
+      return query.fetch()
     
-    return self._bson
-        
\ No newline at end of file
+    if index < 0:
+      raise ValueError('Queries do not support negative indexes')
+    if self._limit and index >= self._limit:
+      raise IndexError('Query index out of range')
+    entity = self.offset(self._offset + index).first()
+    if entity == None:
+      raise IndexError('Query index out of range')
+    return entity
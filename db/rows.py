@@ -0,0 +1,95 @@
+class Row(object):
+  """
+  ' PURPOSE
+  '   Compact, unsaveable representation of an entity. Every model
+  '   has a generated Row subclass (Model.Row) that stores its key
+  '   and property values in __slots__ instead of a __dict__, which
+  '   makes large result sets much smaller and faster to build.
+  ' EXAMPLE USAGE
+  '   Rows are returned by queries run in compact mode.
+  '
+  '   -> for row in Trip.query().iter(compact=True):
+  '   ->   print(row.name, row.author)
+  '
+  '   -> rows = Trip.fetch(compact=True)
+  '   -> trip = rows[0].entity() # full entity, loaded again
+  """
+
+  __slots__ = ('key',)
+
+  # <tuple (str name, Property prop)>, set on generated subclasses
+  _schema = ()
+  # <function serialize_row(row) -> dict>, set on generated subclasses
+  _serialize = None
+
+  @classmethod
+  def from_document(cls, document, key):
+    """
+    ' PURPOSE
+    '   Builds a row from a raw database document.
+    ' PARAMETERS
+    '   <dict document>
+    '   <Key key>
+    ' RETURNS
+    '   <MyModel.Row row>
+    """
+    row = cls.__new__(cls)
+    row.key = key
+    for attr, prop in cls._schema:
+      setattr(row, attr, prop.unpack(document.get(attr)))
+    return row
+
+  def to_dict(self):
+    """
+    ' PURPOSE
+    '   Returns the public dict of this row, see Model.to_dict.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <dict data>
+    """
+    return self._serialize(self)
+
+  @property
+  def kind(self):
+    """
+    ' PURPOSE
+    '   The name of the model this row belongs to.
+    """
+    return self.key.model.__name__
+
+  def entity(self):
+    """
+    ' PURPOSE
+    '   Returns the full, saveable entity this row represents.
+    ' PARAMETERS
+    '   None
+    ' RETURNS
+    '   <MyModel extends Model entity> if it still exists
+    '   None if it no longer exists
+    """
+    return self.key.get()
+
+  def __repr__(self):
+    """
+    ' PURPOSE
+    '   Condensed, unique representation of the row.
+    """
+    return '<db.Row %s>' % self.key.serialize()
+
+
+def make_row_type(modelcls, serialize_row):
+  """
+  ' PURPOSE
+  '   Generates the Row subclass of a model.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  '   <function serialize_row(row) -> dict>
+  ' RETURNS
+  '   <class MyModel.Row extends Row>
+  """
+  return type(modelcls.__name__ + 'Row', (Row,), {
+    '__slots__': tuple(attr for attr, prop in modelcls._schema),
+    '_schema': modelcls._schema,
+    '_serialize': staticmethod(serialize_row)
+  })
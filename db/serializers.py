@@ -0,0 +1,102 @@
+""" LOCAL IMPORTS """
+from .properties import Property
+
+
+def public_fields(modelcls):
+  """
+  ' PURPOSE
+  '   Returns the properties of a model that are serialized, along
+  '   with the name they are serialized under.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  ' RETURNS
+  '   <list (str attr, str public_name, Property prop)>
+  """
+  return [
+    (attr, prop.public_name or attr, prop)
+    for attr, prop in modelcls._schema
+    if not prop.private
+  ]
+
+
+def _compile(name, lines, namespace):
+  """
+  ' PURPOSE
+  '   Compiles the source lines of a serializer function once.
+  ' PARAMETERS
+  '   <str name> the function name
+  '   <list str lines> the function's source
+  '   <dict namespace> the globals the function may use
+  ' RETURNS
+  '   <function serializer>
+  """
+  exec('\n'.join(lines), namespace)
+  return namespace[name]
+
+
+def compile_serializers(modelcls):
+  """
+  ' PURPOSE
+  '   Generates the serializers of a model from its schema. Each one is
+  '   a single function with every field, rename, and conversion laid
+  '   out in advance, so serializing does no reflection at all.
+  ' PARAMETERS
+  '   <class MyModel extends Model>
+  ' RETURNS
+  '   <function serialize_entity(entity) -> dict>
+  '   <function serialize_row(row) -> dict>
+  '   <function serialize_document(document) -> dict>
+  ' NOTES
+  '   1. Private properties are left out and renamed properties are
+  '      serialized under their public_name.
+  '   2. Values are converted by Property.public (entities and rows) or
+  '      Property.export (raw documents), so keys become identifiers.
+  '      Properties that keep their values as is are not called at all.
+  '   3. Raw documents only serialize the fields they hold, which keeps
+  '      projected documents small.
+  """
+  namespace = {}
+  entity_fields = []
+  row_fields = []
+  document_fields = []
+  
+  for index, (attr, public_name, prop) in enumerate(public_fields(modelcls)):
+    prop_ref = 'prop%d' % index
+    namespace[prop_ref] = prop
+    
+    value = 'values.get(%s)' % prop_ref
+    if type(prop).public is not Property.public:
+      namespace['public%d' % index] = prop.public
+      value = 'public%d(%s)' % (index, value)
+    entity_fields.append('    %r: %s,' % (public_name, value))
+    
+    value = 'row.%s' % attr
+    if type(prop).public is not Property.public:
+      value = 'public%d(%s)' % (index, value)
+    row_fields.append('    %r: %s,' % (public_name, value))
+    
+    value = 'document[%r]' % attr
+    if type(prop).export is not Property.export:
+      namespace['export%d' % index] = prop.export
+      value = 'export%d(%s)' % (index, value)
+    document_fields.append('  if %r in document: serialized[%r] = %s' % (attr, public_name, value))
+  
+  serialize_entity = _compile('serialize_entity', [
+    'def serialize_entity(entity):',
+    '  values = entity._values',
+    '  return {',
+    "    'id': entity.key.id if entity.key else None,"
+  ] + entity_fields + ['  }'], namespace)
+  
+  serialize_row = _compile('serialize_row', [
+    'def serialize_row(row):',
+    '  return {',
+    "    'id': row.key.id,"
+  ] + row_fields + ['  }'], namespace)
+  
+  serialize_document = _compile('serialize_document', [
+    'def serialize_document(document):',
+    "  serialized = { 'id': str(document['_id']) }"
+  ] + document_fields + ['  return serialized'], namespace)
+  
+  return serialize_entity, serialize_row, serialize_document
@@ -0,0 +1,85 @@
+""" LOCAL IMPORTS """
+from .cache import entity_cache
+from .connection import database
+
+
+class StorageBackend(object):
+  """
+  ' PURPOSE
+  '   The interface every storage engine implements. Models never
+  '   talk to an engine directly, they ask the current backend for
+  '   the collection of their kind and use the subset of PyMongo's
+  '   Collection API listed below.
+  '     find, find_one, find_one_and_update, count_documents,
+  '     insert_one, update_one, delete_one, bulk_write, drop, create_index
+  ' EXAMPLE USAGE
+  '   -> db.set_backend(db.MemoryBackend())
+  '   -> db.get_backend().collection('UserModel').count_documents({})
+  """
+
+  def collection(self, name):
+    """
+    ' PURPOSE
+    '   Returns the collection that stores the given kind.
+    ' PARAMETERS
+    '   <str name> the collection (model class) name
+    ' RETURNS
+    '   <Collection collection>
+    """
+    raise ValueError('Storage backends must implement collection')
+
+
+class MongoBackend(StorageBackend):
+  """
+  ' PURPOSE
+  '   The default backend, collections live in the MongoDB database
+  '   set up with db.configure.
+  """
+
+  def collection(self, name):
+    return database()[name]
+
+
+""" CURRENT BACKEND """
+_backend = MongoBackend()
+
+
+def set_backend(backend):
+  """
+  ' PURPOSE
+  '   Replaces the storage backend used by every model.
+  ' PARAMETERS
+  '   <StorageBackend backend>
+  ' RETURNS
+  '   Nothing
+  ' NOTES
+  '   1. The entity cache is cleared since its documents belong to
+  '      the previous backend.
+  """
+  global _backend
+  _backend = backend
+  entity_cache.clear()
+
+
+def get_backend():
+  """
+  ' PURPOSE
+  '   Returns the storage backend used by every model.
+  ' PARAMETERS
+  '   None
+  ' RETURNS
+  '   <StorageBackend backend>
+  """
+  return _backend
+
+
+def get_collection(name):
+  """
+  ' PURPOSE
+  '   Returns the current backend's collection for the given kind.
+  ' PARAMETERS
+  '   <str name> the collection (model class) name
+  ' RETURNS
+  '   <Collection collection>
+  """
+  return _backend.collection(name)
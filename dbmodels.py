@@ -1,9 +1,20 @@
 """ GLOBAL IMPORTS """
-import bcrypt
+import hashlib
+import hmac
+import os
 
 
 """ LOCAL IMPORTS """
 import db
+from utils.password_hasher import PasswordHasher
+
+
+""" VERIFIED CREDENTIALS """
+# Digests of (email, password, stored hash) that already passed bcrypt,
+# so repeated Basic Auth requests skip the hash. The digest key is random
+# per process, hence the digests are worthless outside of it.
+CREDENTIAL_KEY = os.urandom(32)
+verified_credentials = db.LRUCache(maxsize=1024, ttl=300)
 
 # [Ben-G] TODO: I create separate files for the User and Trip model
 
@@ -11,18 +22,21 @@ class UserModel(db.Model):
   """
   ' PURPOSE
   '   Contains data for all users
+  '   Serialized as dict( id, email ), see db.Model.to_dict
   """
 
   """ PROPERTIES """
-  email = db.StringProperty()
-  password = db.ByteStringProperty()
+  email = db.StringProperty(unique=True)
+  password = db.ByteStringProperty(private=True)
 
   """ CONSTANTS """
-  # [Ben-G] TODO: It would be greate if this were a property of your
-  # application that way your tests can access and modify the bcrypt rounds.
-  # You want tests to run blazingly fast so you should set the rounds to the
-  # minimum possible of 8.
-  BCRYPT_ROUNDS = 12
+  # not held in db.entity_cache, auth must see a password changed by
+  # another process right away instead of up to the cache's ttl later
+  __cache__ = False
+
+  # runs bcrypt off the request thread, the application replaces it
+  # with one configured from its own bcrypt rounds and pool size.
+  hasher = PasswordHasher()
 
   def hash_password(self, password):
     """
@@ -33,9 +47,7 @@ class UserModel(db.Model):
     ' RETURNS
     '   <bytes hashed>
     """
-    password = password.encode('utf-8')
-    hashed = bcrypt.hashpw(password, bcrypt.gensalt(self.BCRYPT_ROUNDS))
-    return hashed
+    return self.hasher.hash(password)
 
   def set_password(self, password):
     """
@@ -48,7 +60,10 @@ class UserModel(db.Model):
     ' RETURNS
     '   Nothing
     """
+    previous = self.password
     self.password = self.hash_password(password)
+    if previous:
+      verified_credentials.purge(lambda digest, hashed: hashed == previous)
 
   def check_password(self, password):
     """
@@ -60,53 +75,46 @@ class UserModel(db.Model):
     ' RETURNS
     '   True if the passwords match
     '   False if th passwords do not match
+    ' NOTES
+    '   1. Successful checks are remembered in verified_credentials so
+    '      that bcrypt only runs the first time a credential is used.
     """
-    password = password.encode('utf-8')
-    return bcrypt.hashpw(password, self.password) == self.password
+    digest = self.credential_digest(password)
+    if verified_credentials.get(digest): return True
+    
+    matches = self.hasher.check(password, self.password)
+    if matches: verified_credentials.set(digest, self.password)
+    return matches
 
-  def to_dict(self):
+  def credential_digest(self, password):
     """
     ' PURPOSE
-    '   Returns a public dict of this model
+    '   Given a password, returns a fast keyed digest of it along with
+    '   this model's email and stored hash. Used to remember credentials
+    '   that were already verified.
     ' PARAMETERS
-    '   None
+    '   <str password>
     ' RETURNS
-    '   dict( email )
-    '     email -> the user's email
+    '   <str digest>
     """
-    # [Ben-G] TODO: Minor note: you shoudn't need to implement this method
-    # yourself. You should be able to use the `__dict__` method or other
-    # python metaprogramming tools to generate the dictionary automatically
-    return {
-      'email': self.email
-    }
+    message = b'\0'.join([
+      (self.email or '').encode('utf-8'),
+      password.encode('utf-8'),
+      self.password
+    ])
+    return hmac.new(CREDENTIAL_KEY, message, hashlib.sha256).hexdigest()
 
 
 class TripModel(db.Model):
   """
   ' PURPOSE
   '   Contains data for all trips
+  '   Serialized as dict( id, name, author ), see db.Model.to_dict
   """
 
   """ PROPERTIES """
   name = db.StringProperty()
-  author = db.KeyProperty()
+  author = db.KeyProperty(indexed=True)
 
-  def to_dict(self):
-    """
-    ' PURPOSE
-    '   Returns a public dict of this model
-    ' PARAMETERS
-    '   None
-    ' RETURNS
-    '   dict( name, author )
-    '     name -> the name of this trip
-    '     author -> the identifier of the author of this trip
-    """
-    # [Ben-G] TODO: Minor note: you shoudn't need to implement this method
-    # yourself. You should be able to use the `__dict__` method or other
-    # python metaprogramming tools to generate the dictionary automatically
-    return {
-      'name': self.name,
-      'author': self.author.id
-    }
+  """ CONSTANTS """
+  __cache__ = True
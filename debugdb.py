@@ -1,3 +1,7 @@
+import os
+# sessions are only used locally, any fixed key will do
+os.environ.setdefault('SECRET_KEY', 'development')
+
 import db
 import server
 
@@ -1,13 +1,33 @@
+""" GLOBAL IMPORTS """
+import hashlib
+import hmac
+import os
+import sys
+import threading
+from itertools import chain, islice
+from types import GeneratorType
+
+
 """ FLASK IMPORTS """
-from flask import Flask, request, make_response, jsonify, abort
+from flask import Flask, Response, request, make_response, jsonify, abort
 from flask_restful import Resource, Api
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
 
 """ MONGO IMPORTS """
-from utils.mongo_json_encoder import JSONEncoder
+from bson.objectid import ObjectId
+
+
+""" JSON IMPORTS """
+from utils.json_backends import get_backend, stream_array
+
+
+""" PASSWORD HASHING IMPORTS """
+from utils.password_hasher import PasswordHasher, PasswordHasherBusy
 
 
 """ LOCAL IMPORTS """
+import db
 from dbmodels import UserModel, TripModel
 
 
@@ -15,29 +35,256 @@ from dbmodels import UserModel, TripModel
 app = Flask(__name__)
 api = Api(app)
 
+# Tokens are signed with SECRET_KEY, every worker must share the same
+# one for tokens to be accepted across workers and restarts. Required,
+# set it in the environment or in the SERVER_SETTINGS file.
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+# seconds a session token stays valid
+app.config['SESSION_MAX_AGE'] = 24 * 60 * 60
+# when False session tokens are trusted without loading the user, the
+# current_user is then a read-only partial entity built from the token.
+app.config['SESSION_VERIFY_USER'] = True
+# bcrypt cost factor, tests should lower it to the minimum of 4
+app.config['BCRYPT_ROUNDS'] = 12
+# bcrypt runs on at most this many workers, once PASSWORD_HASH_MAX_PENDING
+# hashes are running or queued further ones are rejected with a 503
+# PASSWORD_HASH_MAX_PENDING must stay smaller than the request threads of
+# a worker (e.g. gunicorn --threads) so hashes can never hold all of them
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_MAX_PENDING'] = 4
+# seconds a request waits for its hash before it is answered with a 503
+app.config['PASSWORD_HASH_TIMEOUT'] = 5
+# use processes instead of threads for the bcrypt workers
+app.config['PASSWORD_HASH_PROCESSES'] = False
+# default and max amount of trips returned per page by GET /trips/
+app.config['TRIPS_PAGE_LIMIT'] = 100
+app.config['TRIPS_MAX_PAGE_LIMIT'] = 1000
+# 'auto', 'stdlib', or 'orjson', auto uses orjson when it is installed
+app.config['JSON_BACKEND'] = 'auto'
+# arrays (or generated results) of at least this many items are streamed
+# as chunked responses
+app.config['JSON_STREAM_THRESHOLD'] = 500
+# 'mongo', or 'memory' to keep every collection in memory (nothing is persisted)
+app.config['DATABASE_BACKEND'] = os.environ.get('DATABASE_BACKEND', 'mongo')
+# MongoDB connection, the client connects lazily on first use so that
+# pre-fork workers each open their own pool
+app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
+app.config['MONGO_DATABASE'] = os.environ.get('MONGO_DATABASE', 'develop_database')
+app.config['MONGO_MAX_POOL_SIZE'] = 100
+app.config['MONGO_MIN_POOL_SIZE'] = 0
+# millisecond timeouts keyed by connect, socket, server_selection or wait_queue
+app.config['MONGO_TIMEOUTS'] = {}
+app.config['MONGO_READ_PREFERENCE'] = None
+app.config['MONGO_WRITE_CONCERN'] = None
+# create missing indexes before the first request each process serves,
+# can be turned off when every deploy runs python server.py ensure-indexes
+app.config['ENSURE_INDEXES'] = True
+
+# any of the above may be overridden by the python file SERVER_SETTINGS points to
+app.config.from_envvar('SERVER_SETTINGS', silent=True)
+
+if not app.config['SECRET_KEY']:
+  # a generated key would differ per worker and per restart, making
+  # tokens fail at random, so refuse to start without a shared one
+  raise RuntimeError('SECRET_KEY must be set in the environment or the SERVER_SETTINGS file')
+
+
+def configure_password_hasher():
+  """
+  ' PURPOSE
+  '   Replaces the UserModel's password hasher with one built from
+  '   the application's configuration. Call again after changing it.
+  """
+  UserModel.hasher = PasswordHasher(
+    rounds=app.config['BCRYPT_ROUNDS'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+    processes=app.config['PASSWORD_HASH_PROCESSES'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+
+configure_password_hasher()
+
+
+""" DATABASE SETUP """
+# whether this process ensured the indexes of the configured database
+_indexes_ensured = False
+_indexes_lock = threading.Lock()
+
+def configure_database():
+  """
+  ' PURPOSE
+  '   Points the db library at the database from the application's
+  '   configuration. Call again after changing it.
+  """
+  global _indexes_ensured
+  _indexes_ensured = False
+  if app.config['DATABASE_BACKEND'] == 'memory':
+    db.set_backend(db.MemoryBackend())
+    return
+  db.set_backend(db.MongoBackend())
+  db.configure(
+    uri=app.config['MONGO_URI'],
+    database=app.config['MONGO_DATABASE'],
+    max_pool_size=app.config['MONGO_MAX_POOL_SIZE'],
+    min_pool_size=app.config['MONGO_MIN_POOL_SIZE'],
+    timeouts=app.config['MONGO_TIMEOUTS'],
+    read_preference=app.config['MONGO_READ_PREFERENCE'],
+    write_concern=app.config['MONGO_WRITE_CONCERN'])
+
+configure_database()
+
+
+def ensure_indexes():
+  """
+  ' PURPOSE
+  '   Creates any index declared by the models that is missing. It is
+  '   idempotent and connects to the database, so it runs as a deploy
+  '   step (python server.py ensure-indexes), when the development
+  '   server starts, or before the first request, never on import.
+  """
+  return db.ensure_indexes()
+
+
+""" REQUEST LIFECYCLE """
+@app.before_request
+def ensure_indexes_once():
+  """
+  ' PURPOSE
+  '   Ensures the indexes once per process, before the first request
+  '   it serves. A failed attempt is retried by the next request.
+  """
+  global _indexes_ensured
+  if _indexes_ensured or not app.config['ENSURE_INDEXES']: return
+  with _indexes_lock:
+    if not _indexes_ensured:
+      ensure_indexes()
+      _indexes_ensured = True
+
+@app.before_request
+def open_identity_map():
+  """
+  ' PURPOSE
+  '   Gives every request its own db identity map so that an
+  '   entity loaded several times in one request is only read
+  '   from the database once.
+  """
+  db.start_request()
+
+@app.teardown_request
+def close_identity_map(exception=None):
+  """
+  ' PURPOSE
+  '   Discards the request's db identity map.
+  """
+  db.end_request()
+
+
+""" SESSIONS """
+def session_serializer():
+  """
+  ' PURPOSE
+  '   Returns the serializer used to sign and verify session tokens.
+  """
+  return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='session')
+
+def password_fingerprint(user):
+  """
+  ' PURPOSE
+  '   Given a user, returns a short keyed digest of its stored password
+  '   hash. Embedded in session tokens so that changing the password
+  '   revokes every token issued before the change.
+  ' PARAMETERS
+  '   <UserModel user>
+  ' RETURNS
+  '   <str fingerprint>
+  """
+  secret = app.config['SECRET_KEY']
+  if isinstance(secret, str): secret = secret.encode('utf-8')
+  return hmac.new(secret, user.password, hashlib.sha256).hexdigest()[:16]
+
+def issue_session_token(user):
+  """
+  ' PURPOSE
+  '   Given a user, returns a signed token identifying that user.
+  ' PARAMETERS
+  '   <UserModel user>
+  ' RETURNS
+  '   <str token>
+  """
+  return session_serializer().dumps({
+    'id': user.key.id,
+    'email': user.email,
+    'fingerprint': password_fingerprint(user)
+  })
+
+def verify_session_token(token):
+  """
+  ' PURPOSE
+  '   Given a session token, returns the user it identifies. No
+  '   password hashing is involved.
+  ' PARAMETERS
+  '   <str token>
+  ' RETURNS
+  '   <UserModel user> if the token is valid
+  '   None if the token is invalid, expired, or revoked
+  """
+  try:
+    claims = session_serializer().loads(token, max_age=app.config['SESSION_MAX_AGE'])
+  except (BadSignature, SignatureExpired):
+    return None
+  
+  if not app.config['SESSION_VERIFY_USER']:
+    return UserModel.from_document({ '_id': claims['id'], 'email': claims['email'] }, partial=True)
+  
+  user = UserModel.get_by_id(claims['id'])
+  if not user or password_fingerprint(user) != claims['fingerprint']: return None
+  return user
+
+def verify_credentials(email, password):
+  """
+  ' PURPOSE
+  '   Given an email and password, returns the matching user.
+  ' PARAMETERS
+  '   <str email>
+  '   <str password>
+  ' RETURNS
+  '   <UserModel user> if the credentials are valid
+  '   None if the credentials are invalid
+  ' NOTES
+  '   1. Aborts with 503 when too many password checks are pending.
+  """
+  user = UserModel.query(UserModel.email == email).first()
+  if not user: return None
+  
+  try:
+    if not user.check_password(password): return None
+  except PasswordHasherBusy:
+    return abort(503)
+  return user
+
 
 """ DECORATORS """
 def auth(f):
   """
   ' PURPOSE
-  '   Forces a given request to contain a valid Basic Authorization
-  '   header using the UserModel as the auth database check.
+  '   Forces a given request to contain either a valid Bearer session
+  '   token or a valid Basic Authorization header using the UserModel
+  '   as the auth database check.
   ' NOTES
   '   1. Adds an additional kwarg ( current_user ) which contains the
-  '      entity of the current user based on the Basic Auth.
+  '      entity of the current user based on the token or Basic Auth.
+  '   2. Session tokens are obtained through the /sessions/ resource.
   """
   def handle(*args, **kwargs):
-    basic = request.authorization
-    if not basic: return abort(401)
-    
-    email = basic.username
-    password = basic.password
-    
-    users = UserModel.fetch(UserModel.email == email)
-    if len(users) == 0: return abort(401)
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+      user = verify_session_token(header[len('Bearer '):].strip())
+    else:
+      basic = request.authorization
+      if not basic: return abort(401)
+      user = verify_credentials(basic.username, basic.password)
     
-    user = users[0]
-    if not user.check_password(password): return abort(401)
+    if not user: return abort(401)
     
     kwargs['current_user'] = user
     
@@ -93,10 +340,18 @@ class Users(Resource):
     ' RETURNS
     '   dict( id )
     '     id -> the identifier of the created user
+    ' NOTES
+    '   1. Aborts with 409 if the email is already taken.
     """
     user = UserModel(email=email)
-    user.set_password(password)
-    user.save()
+    try:
+      user.set_password(password)
+    except PasswordHasherBusy:
+      return abort(503)
+    try:
+      user.save()
+    except db.DuplicateKeyError:
+      return abort(409)
     return { 'id': user.key.id }
   
   @auth
@@ -112,6 +367,35 @@ class Users(Resource):
     return current_user.to_dict()
 
 
+class Sessions(Resource):
+  """
+  ' PURPOSE
+  '   Trades an email and password for a session token which can
+  '   then be sent as a Bearer Authorization header instead of Basic
+  '   Auth, skipping the password check on every request.
+  """
+
+  @parameters('email', 'password')
+  def post(self, email=None, password=None):
+    """
+    ' PURPOSE
+    '   Given an email and password, create a new session.
+    ' PARAMETERS
+    '   <str email>
+    '   <str password>
+    ' RETURNS
+    '   dict( token, expires_in )
+    '     token -> the signed session token
+    '     expires_in -> seconds until the token expires
+    """
+    user = verify_credentials(email, password)
+    if not user: return abort(401)
+    return {
+      'token': issue_session_token(user),
+      'expires_in': app.config['SESSION_MAX_AGE']
+    }
+
+
 class Trips(Resource):
   """
   ' PURPOSE
@@ -139,14 +423,51 @@ class Trips(Resource):
   def get(self):
     """
     ' PURPOSE
-    '   Returns the public dicts for all trips.
+    '   Returns the public dicts for a page of trips, newest first.
     ' PARAMETERS
-    '   None
+    '   optional <int limit> query arg, the max amount of trips to return
+    '   optional <str cursor> query arg, the X-Next-Cursor of the
+    '                         previous page
     ' RETURNS
     '   [<dict entity1>, ..., <dict entityN>]
+    ' NOTES
+    '   1. When more trips may follow, the X-Next-Cursor response header
+    '      holds the cursor of the next page.
+    '   2. Aborts with 400 if the limit or cursor are malformed.
+    '   3. Pages of at least JSON_STREAM_THRESHOLD trips are streamed
+    '      while they are read from the database.
     """
-    entities = TripModel.fetch()
-    return [entity.to_dict() for entity in entities]
+    limit = app.config['TRIPS_PAGE_LIMIT']
+    if 'limit' in request.args:
+      try:
+        limit = int(request.args['limit'])
+      except ValueError:
+        return abort(400)
+    if limit < 1 or limit > app.config['TRIPS_MAX_PAGE_LIMIT']: return abort(400)
+    
+    start_after = None
+    if 'cursor' in request.args:
+      try:
+        start_after = db.Key(urlsafe=request.args['cursor'])
+      except ValueError:
+        return abort(400)
+      if start_after.model != TripModel: return abort(400)
+      if not ObjectId.is_valid(start_after.id): return abort(400)
+    
+    query = TripModel.query().project(TripModel.name, TripModel.author)
+    if start_after: query = query.start_after(start_after)
+    
+    # the page's last key is read ahead from the _id index so that its
+    # cursor header can be sent before the trips are streamed, the page
+    # then ends at it even if trips were created in between
+    last = next(query.offset(limit - 1).limit(1).iter(keys_only=True), None)
+    headers = {}
+    if last:
+      headers['X-Next-Cursor'] = last.urlsafe()
+      query = query.end_at(last)
+    else:
+      query = query.limit(limit)
+    return query.iter(raw=True), 200, headers
   
   # returns amount of deleted
   def delete(self):
@@ -193,9 +514,9 @@ class SpecificTrip(Resource):
     ' RETURNS
     '   dict *see the TripModel for specs*
     """
-    entity = TripModel.get_by_id(id)
-    if not entity: return abort(400)
-    return entity.to_dict()
+    trip = TripModel.get_dict_by_id(id, projection=[TripModel.name, TripModel.author])
+    if not trip: return abort(400)
+    return trip
 
 
 """ RESTFUL API RESOURCE ROUTING """
@@ -204,16 +525,37 @@ api.add_resource(SpecificTrip, '/trips/<string:id>/')
 
 api.add_resource(Users, '/users/')
 
+api.add_resource(Sessions, '/sessions/')
+
 
 """ CUSTOM JSON SERIALIZER FOR flask_restful """
 @api.representation('application/json')
 def output_json(data, code, headers=None):
-    resp = make_response(JSONEncoder().encode(data), code)
+    backend = get_backend(app.config['JSON_BACKEND'])
+    threshold = app.config['JSON_STREAM_THRESHOLD']
+    streamed = None
+    if isinstance(data, GeneratorType):
+        # read up to the threshold, a shorter result is sent whole and
+        # a longer one is streamed while the rest is still being read
+        head = list(islice(data, threshold))
+        if len(head) == threshold:
+            streamed = chain(head, data)
+        data = head
+    elif isinstance(data, list) and len(data) >= threshold:
+        streamed = data
+    if streamed is not None:
+        resp = Response(stream_array(backend, streamed), code, mimetype='application/json')
+    else:
+        resp = make_response(backend.dumps(data), code)
     resp.headers.extend(headers or {})
     return resp
 
 
 """ START SERVER """
 if __name__ == '__main__':
+    if sys.argv[1:] == ['ensure-indexes']:
+        print('\n'.join(ensure_indexes()))
+        sys.exit(0)
+    ensure_indexes_once()
     app.config['TRAP_BAD_REQUEST_ERRORS'] = True
     app.run(port=8080, debug=True)
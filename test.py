@@ -1,5 +1,19 @@
+import asyncio
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# sessions are only used locally, any fixed key will do
+os.environ.setdefault('SECRET_KEY', 'development')
+
 import db
 import server
+import dbmodels
+from dbmodels import UserModel, TripModel
 
 
 
@@ -9,12 +23,12 @@ import server
 def TestKeysandIds():
   class Test(db.Model):
   
-    value1 = db.TextProperty()
-    value2 = db.TextProperty()
+    value1 = db.StringProperty()
+    value2 = db.StringProperty()
   
   entity = Test()
   entity.value1 = 'Test'
-  entity.put()
+  entity.save()
   print(entity)
 
   print(entity.packed())
@@ -48,7 +62,7 @@ def TestKeysandIds():
 
   entity = Test(id=key.id)
   entity.value3 = 4
-  entity.put()
+  entity.save()
   print(entity)
 
   print(entity.packed())
@@ -68,7 +82,7 @@ def TestKeysandIds():
 
 
 class Reference(db.Model):
-  value1 = db.TextProperty()
+  value1 = db.StringProperty()
   value2 = db.BooleanProperty()
   other = db.KeyProperty()
 
@@ -78,7 +92,7 @@ def TestPropertyPacking():
   entity = Reference()
   entity.value1 = 'E1V1'
   entity.value2 = True
-  entity.put()
+  entity.save()
   
   print('First Entity Key   : %s' % entity.key)
   
@@ -86,7 +100,7 @@ def TestPropertyPacking():
   entity2.value1 = 'E2V1'
   entity2.value2 = False
   entity2.other = entity.key
-  entity2.put()
+  entity2.save()
 
   print('Second Entity Key  : %s' % entity2.key)
   
@@ -96,9 +110,629 @@ def TestPropertyPacking():
 
 
 
+class Note(db.Model):
+  title = db.StringProperty()
+  body = db.StringProperty()
+  tags = db.ListProperty(db.StringProperty())
+  views = db.IntegerProperty()
+  rating = db.FloatProperty()
+  __versioned__ = True
+
+
+class Profile(db.Model):
+  handle = db.StringProperty(public_name='username')
+  secret = db.StringProperty(private=True)
+  owner = db.KeyProperty(public_name='owner_id')
+  bio = db.StringProperty()
+
+
+def memory_backend():
+  # every behavior test starts from an empty in memory database
+  db.set_backend(db.MemoryBackend())
+  db.ensure_indexes(UserModel, TripModel, Note)
+
+
+@contextmanager
+def app_config(**config):
+  # changes the application's config for the block, bcrypt at its
+  # minimum cost unless given, and puts every value back afterwards
+  config.setdefault('BCRYPT_ROUNDS', 4)
+  previous = dict((name, server.app.config[name]) for name in config)
+  server.app.config.update(config)
+  server.configure_password_hasher()
+  try:
+    yield server.app.test_client()
+  finally:
+    server.app.config.update(previous)
+    server.configure_password_hasher()
+
+
+def basic_auth(email, password):
+  credentials = base64.b64encode(('%s:%s' % (email, password)).encode('utf-8'))
+  return { 'Authorization': 'Basic ' + credentials.decode('ascii') }
+
+
+def TestGetMultiOrdering():
+  memory_backend()
+  notes = db.Model.put_multi([Note(title='a'), Note(title='b')])
+  user = UserModel(email='get@multi.com')
+  user.save()
+  missing = Note.key_from_id('000000000000000000000000')
+
+  keys = [notes[1].key, missing, user.key, notes[0].key]
+  found = db.Key.get_multi(keys)
+  assert [entity and entity.key.id for entity in found] == [notes[1].key.id, None, user.key.id, notes[0].key.id]
+  assert Note.get_by_ids(['not an id', notes[0].key.id])[0] is None
+  print('get_multi keeps the key order and returns None for missing entities')
+
+
+def TestPutMultiErrors():
+  memory_backend()
+  UserModel(email='taken@put.com').save()
+  users = [
+    UserModel(email='first@put.com'),
+    UserModel(email='taken@put.com'),
+    UserModel(email='second@put.com')
+  ]
+  try:
+    db.Model.put_multi(users)
+    assert False, 'expected a MultiWriteError'
+  except db.MultiWriteError as error:
+    assert [bool(message) for message in error.errors] == [False, True, False]
+  assert users[0].key and users[2].key and users[1].key is None
+  assert UserModel.count() == 3
+  print('put_multi aligns its errors with the given entities')
+
+
+def TestDirtyUpdates():
+  memory_backend()
+  note = Note(title='title', body='body')
+  note.save()
+  collection = db.get_backend().collection('Note')
+  assert note._changes() == {}
+
+  # a field changed by someone else must survive an unrelated save
+  collection.update_one({ '_id': note._selector()['_id'] }, { '$set': { 'body': 'theirs' } })
+  note.title = 'new title'
+  changes = note._changes()
+  assert changes['$set'] == { 'title': 'new title' } and '$unset' not in changes
+  note.save()
+  document = collection.find_one({ '_id': note._selector()['_id'] })
+  assert document['title'] == 'new title' and document['body'] == 'theirs'
+
+  note = Note.get_by_id(note.key.id)
+  note.body = None
+  assert note._changes()['$unset'] == { 'body': '' }
+  note.save()
+  assert 'body' not in collection.find_one({ '_id': note._selector()['_id'] })
+  print('saves only $set and $unset the changed properties')
+
+
+def TestVersionedConflicts():
+  memory_backend()
+  note = Note(title='v1')
+  note.save()
+  mine, theirs = Note.get_by_id(note.key.id), Note.get_by_id(note.key.id)
+
+  theirs.title = 'theirs'
+  theirs.save()
+  mine.title = 'mine'
+  try:
+    mine.save()
+    assert False, 'expected a ConcurrentModificationError'
+  except db.ConcurrentModificationError:
+    pass
+
+  stale = Note.get_by_id(note.key.id)
+  fresh = Note.get_by_id(note.key.id)
+  fresh.title = 'fresh'
+  db.Model.put_multi([fresh])
+  stale.title = 'stale'
+  try:
+    db.Model.put_multi([stale])
+    assert False, 'expected a MultiWriteError'
+  except db.MultiWriteError as error:
+    assert error.errors[0]
+  assert Note.get_by_id(note.key.id).title == 'fresh'
+  print('versioned models reject saves of stale entities')
+
+
+def TestPartialSaves():
+  memory_backend()
+  Note(title='partial', body='body').save()
+  note = Note.fetch(projection=[Note.title])[0]
+  assert note.title == 'partial' and note.body is None
+
+  for attempt in (lambda: setattr(note, 'title', 'x'), note.save, lambda: db.Model.put_multi([note])):
+    try:
+      attempt()
+      assert False, 'expected a PartialEntityError'
+    except db.PartialEntityError:
+      pass
+  assert Note.get_by_id(note.key.id).body == 'body'
+  print('partial entities can not be changed or saved')
+
+
+def TestTripPagination():
+  memory_backend()
+  client = server.app.test_client()
+
+  author = UserModel(email='pages@trips.com')
+  author.save()
+  for i in range(7):
+    TripModel(name='Trip %d' % i, author=author.key).save()
+
+  names, cursor = [], ''
+  while True:
+    response = client.get('/trips/?limit=3' + cursor)
+    assert response.status_code == 200
+    names += [trip['name'] for trip in json.loads(response.data.decode('utf-8'))]
+    if not response.headers.get('X-Next-Cursor'): break
+    cursor = '&cursor=' + response.headers['X-Next-Cursor']
+  assert names == ['Trip %d' % i for i in reversed(range(7))]
+
+  bad_id = db.Key(TripModel, 'zzz').urlsafe()
+  for query in ('limit=abc', 'limit=0', 'cursor=@@', 'cursor=' + author.key.urlsafe(), 'cursor=' + bad_id):
+    assert client.get('/trips/?' + query).status_code == 400, query
+  print('trip pages follow X-Next-Cursor and reject malformed arguments')
+
+
+def TestFilters():
+  memory_backend()
+  for title, tags in (('Paris', ['city', 'fr']), ('Parma', ['city', 'it']), ('Rome', ['it']), ('P.S.', [])):
+    Note(title=title, tags=tags).save()
+
+  def titles(*filters):
+    return sorted(note.title for note in Note.fetch(*filters))
+
+  assert titles(db.OR(Note.title == 'Rome', Note.title == 'Paris')) == ['Paris', 'Rome']
+  assert titles(db.IN(Note.title, ['Rome', 'Oslo'])) == ['Rome']
+  assert titles(db.NOT_IN(Note.title, ['Rome', 'Paris'])) == ['P.S.', 'Parma']
+  assert titles(db.PREFIX(Note.title, 'Par')) == ['Paris', 'Parma']
+  assert titles(db.PREFIX(Note.title, 'P.')) == ['P.S.']
+  assert titles(db.NOT(db.PREFIX(Note.title, 'P'))) == ['Rome']
+  assert titles(Note.tags == 'it', db.NOT(Note.title == 'Rome')) == ['Parma']
+  assert titles(db.IN(Note.tags, ['fr', 'it'])) == ['Paris', 'Parma', 'Rome']
+  assert titles(db.AND(Note.tags == 'city', db.OR(Note.title == 'Rome', Note.title == 'Parma'))) == ['Parma']
+
+  assert TripModel.query(TripModel.author == UserModel.key_from_id('0' * 24)).expected_index().names == ('author',)
+  assert TripModel.query(TripModel.name == 'x').expected_index() is None
+  print('OR, IN, NOT_IN, NOT and PREFIX filters match like MongoDB')
+
+
+def TestDeleteMulti():
+  memory_backend()
+  notes = db.Model.put_multi([Note(title='a'), Note(title='b')])
+  user = UserModel(email='delete@multi.com')
+  user.save()
+  try:
+    db.Model.delete_multi([notes[0].key, Note.key_from_id('malformed'), user.key])
+    assert False, 'expected a MultiWriteError'
+  except db.MultiWriteError as error:
+    assert [bool(message) for message in error.errors] == [False, True, False]
+  assert Note.count() == 1 and UserModel.count() == 0
+  assert db.Model.delete_multi([notes[1].key]) == 1
+  print('delete_multi reports malformed keys and deletes the rest')
+
+
+def TestEntityCache():
+  memory_backend()
+  author = UserModel(email='cache@trips.com')
+  author.save()
+  trip = TripModel(name='Cached', author=author.key)
+  trip.save()
+  serial = trip.key.serialize()
+  assert db.entity_cache.get(serial)['name'] == 'Cached'
+  assert not db.entity_cache.get(author.key.serialize())
+
+  # a read that started before a write cannot cache the old document
+  generation = db.entity_cache.generation()
+  stale = db.entity_cache.get(serial)
+  trip.name = 'Renamed'
+  trip.save()
+  assert not db.entity_cache.set(serial, stale, generation)
+  assert TripModel.get_by_id(trip.key.id).name == 'Renamed'
+
+  # nor one that started before a purge, whatever its key
+  generation = db.entity_cache.generation()
+  TripModel.delete_all()
+  assert not db.entity_cache.set(serial, stale, generation)
+
+  # the cache is dropped even when the write fails
+  db.entity_cache.set(serial, stale)
+  try:
+    with db.cache.uncache_after(TripModel, [trip.key]):
+      raise RuntimeError('write failed')
+  except RuntimeError:
+    pass
+  assert not db.entity_cache.get(serial)
+  print('the entity cache never holds a document older than a write')
+
+
+def TestAtomicUpdates():
+  memory_backend()
+  note = Note(title='atomic', tags=['a'], views=0, rating=1.5)
+  note.save()
+  missing = Note.key_from_id('0' * 24)
+
+  assert Note.increment(note.key, Note.views) == 1
+  assert Note.increment(note.key, Note.views, 2) == 3
+  assert Note.increment(note.key, Note.rating) == 2.5
+  assert isinstance(Note.increment(note.key.id, Note.rating, -2), float)
+  assert Note.increment(missing, Note.views) is None
+  for n in (1.5, '1', True):
+    try:
+      Note.increment(note.key, Note.views, n)
+      assert False, 'expected a ValueError for %r' % (n,)
+    except ValueError:
+      pass
+
+  assert Note.push(note.key, Note.tags, 'b') and Note.push(note.key, Note.tags, 'a')
+  assert Note.pull(note.key, Note.tags, 'a')
+  assert not Note.push(missing, Note.tags, 'a')
+
+  assert not Note.compare_and_set(note.key, Note.title, 'other', 'lost')
+  assert Note.compare_and_set(note.key, Note.title, 'atomic', 'won')
+  assert Note.compare_and_set(note.key, Note.title, 'won', None)
+
+  note = Note.get_by_id(note.key.id)
+  assert (note.title, note.tags, note.views, note.rating) == (None, ['b'], 3, 0.5)
+  assert note._version == 1 + 9 # one bump per update that matched
+  print('increment, push, pull and compare_and_set update without loading')
+
+
+def TestConfigureAndDeletes():
+  settings = json.dumps(db.connection._settings, sort_keys=True)
+  try:
+    db.configure('mongodb://elsewhere', timeouts={ 'wait_queue': 100, 'wait': 100 })
+    assert False, 'expected a ValueError for the unknown timeout'
+  except ValueError as error:
+    assert "'wait'" in str(error)
+  assert json.dumps(db.connection._settings, sort_keys=True) == settings
+
+  memory_backend()
+  notes = db.Model.put_multi([Note(title='a'), Note(title='b'), Note(title='c')])
+  assert notes[0].key.delete() == 1 and notes[0].key.delete() == 0
+  assert Note.delete_all() == 2 and Note.count() == 0
+  print('configure rejects unknown timeouts and deletes report their counts')
+
+
+def TestIndexesOnFirstRequest():
+  backend = server.app.config['DATABASE_BACKEND']
+  ensure_indexes = server.ensure_indexes
+  calls = []
+  def counted():
+    calls.append(True)
+    return ensure_indexes()
+  server.app.config['DATABASE_BACKEND'] = 'memory'
+  server.ensure_indexes = counted
+  try:
+    server.configure_database()
+    client = server.app.test_client()
+    assert client.get('/trips/').status_code == 200
+    assert client.get('/trips/').status_code == 200
+    assert len(calls) == 1
+    assert 'author_1' in db.get_backend().collection('TripModel').index_information()
+  finally:
+    server.app.config['DATABASE_BACKEND'] = backend
+    server.ensure_indexes = ensure_indexes
+  print('indexes are ensured once, before the first request')
+
+
+def TestTripStreaming():
+  memory_backend()
+  threshold = server.app.config['JSON_STREAM_THRESHOLD']
+  server.app.config['JSON_STREAM_THRESHOLD'] = 3
+  try:
+    client = server.app.test_client()
+    author = UserModel(email='stream@trips.com')
+    author.save()
+    for i in range(7):
+      TripModel(name='Trip %d' % i, author=author.key).save()
+
+    response = client.get('/trips/?limit=5')
+    assert 'Content-Length' not in response.headers
+    assert [trip['name'] for trip in json.loads(response.data.decode('utf-8'))] == ['Trip %d' % i for i in (6, 5, 4, 3, 2)]
+    cursor = db.Key(urlsafe=response.headers['X-Next-Cursor'])
+    assert TripModel.get_by_id(cursor.id).name == 'Trip 2'
+
+    response = client.get('/trips/?limit=2')
+    assert response.headers['Content-Length'] and len(json.loads(response.data.decode('utf-8'))) == 2
+
+    # a page read up to its cursor keeps the trips created meanwhile
+    TripModel(name='Trip 7', author=author.key).save()
+    page = TripModel.query().end_at(cursor).iter(raw=True)
+    assert [trip['name'] for trip in page] == ['Trip %d' % i for i in (7, 6, 5, 4, 3, 2)]
+  finally:
+    server.app.config['JSON_STREAM_THRESHOLD'] = threshold
+  print('long trip pages are streamed as they are read')
+
+
+def TestConcurrentAsyncRequests():
+  memory_backend()
+  note = Note(title='shared')
+  note.save()
+  both_started = asyncio.Event()
+  started = []
+
+  async def request(title):
+    db.start_request()
+    try:
+      first = await db.aio.run(Note.get_by_id, note.key.id)
+      started.append(title)
+      if len(started) == 2: both_started.set()
+      await both_started.wait()
+      # the other request is running now, it must not see this change
+      first.title = title
+      second = await db.aio.run(Note.get_by_id, note.key.id)
+      assert second is first and second.title == title
+      return db.context.identity_map(), first
+    finally:
+      db.end_request()
+
+  async def main():
+    return await asyncio.gather(request('one'), request('two'))
+
+  (map_one, note_one), (map_two, note_two) = asyncio.run(main())
+  assert map_one is not map_two and note_one is not note_two
+  assert db.context.identity_map() is None
+  print('concurrent asyncio requests each get their own identity map')
+
+
+def TestIdentityMap():
+  memory_backend()
+  note = Note(title='mapped')
+  note.save()
+  db.start_request()
+  try:
+    first = Note.get_by_id(note.key.id)
+    assert Note.get_by_id(note.key.id) is first
+    assert note.key.get() is first and db.Key.get_multi([note.key])[0] is first
+    note.key.delete()
+    assert Note.get_by_id(note.key.id) is None
+  finally:
+    db.end_request()
+  other = Note(title='unmapped')
+  other.save()
+  assert Note.get_by_id(other.key.id) is not Note.get_by_id(other.key.id)
+  print('a request loads each entity once and forgets deleted ones')
+
+
+def TestCountsAndSlices():
+  memory_backend()
+  for title in ('a', 'b', 'c', 'd', 'e'):
+    Note(title=title, tags=['vowel'] if title in 'ae' else []).save()
+
+  assert Note.count() == 5 and Note.count(Note.tags == 'vowel') == 2
+  assert Note.exists(Note.title == 'c') and not Note.exists(Note.title == 'z')
+  query = Note.query()
+  assert query.offset(1).limit(3).count() == 3 and query.offset(4).limit(3).count() == 1
+
+  # newest first
+  titles = lambda notes: [note.title for note in notes]
+  assert query.first().title == 'e' and Note.query(Note.title == 'z').first() is None
+  assert query[0].title == 'e' and query[4].title == 'a'
+  assert titles(query[1:3]) == ['d', 'c'] and titles(query[3:]) == ['b', 'a']
+  assert titles(query.limit(3)[1:]) == ['d', 'c'] and query.limit(3)[5:] == []
+  for index in (5, slice(-1, None), slice(0, 4, 2)):
+    try:
+      query[index]
+      assert False, 'expected an error for %r' % (index,)
+    except (IndexError, ValueError):
+      pass
+  print('count, exists, first and slices read only what they need')
+
+
+def TestCompactRows():
+  memory_backend()
+  author = UserModel(email='rows@trips.com')
+  author.save()
+  trips = [TripModel(name='Trip %d' % i, author=author.key).save() for i in range(3)]
+
+  rows = TripModel.fetch(compact=True)
+  assert [row.name for row in rows] == ['Trip 2', 'Trip 1', 'Trip 0']
+  row = rows[0]
+  assert isinstance(row, TripModel.Row) and not hasattr(row, '__dict__')
+  assert row.kind == 'TripModel' and row.author.serialize() == author.key.serialize()
+  assert row.to_dict() == trips[2].to_dict()
+  assert row.entity().key.serialize() == trips[2].key.serialize() and not hasattr(row, 'save')
+  try:
+    row.extra = 1
+    assert False, 'expected an AttributeError'
+  except AttributeError:
+    pass
+  assert [row.name for row in TripModel.query().iter(compact=True)][:1] == ['Trip 2']
+  print('compact rows hold the same data as entities in __slots__')
+
+
+def TestRawDicts():
+  memory_backend()
+  user = UserModel(email='raw@dicts.com', password=b'hashed')
+  user.save()
+  trip = TripModel(name='Raw', author=user.key).save()
+
+  assert UserModel.fetch(raw=True) == [{ 'id': user.key.id, 'email': 'raw@dicts.com' }]
+  assert list(TripModel.fetch_dicts()) == [trip.to_dict()]
+  assert TripModel.fetch(raw=True, projection=[TripModel.name]) == [{ 'id': trip.key.id, 'name': 'Raw' }]
+  assert TripModel.get_dict_by_id(trip.key.id) == trip.to_dict()
+  assert TripModel.get_dict_by_id(trip.key.id, projection=[TripModel.author]) == { 'id': trip.key.id, 'author': user.key.id }
+  assert TripModel.get_dict_by_id('malformed') is None and TripModel.get_dict_by_id('0' * 24) is None
+  print('raw fetches return the public dicts without building entities')
+
+
+def TestSerializers():
+  memory_backend()
+  owner = UserModel(email='profile@owner.com')
+  owner.save()
+  profile = Profile(handle='jd', secret='hidden', owner=owner.key)
+  profile.save()
+
+  expected = { 'id': profile.key.id, 'username': 'jd', 'owner_id': owner.key.id, 'bio': None }
+  assert profile.to_dict() == expected
+  assert Profile.fetch(compact=True)[0].to_dict() == expected
+  assert Profile.fetch(raw=True) == [expected]
+  assert Profile.get_dict_by_id(profile.key.id, projection=[Profile.secret, Profile.handle]) == { 'id': profile.key.id, 'username': 'jd' }
+  print('to_dict leaves private fields out and renames public ones')
+
+
+def TestIncludeQueries():
+  memory_backend()
+  users = [UserModel(email='include%d@trips.com' % i) for i in range(3)]
+  notes = [Note(title='owner %d' % i) for i in range(2)]
+  db.Model.put_multi(users + notes)
+  for i in range(6):
+    Profile(handle='p%d' % i, owner=(users + notes)[i % 5].key).save()
+
+  find = db.memory.MemoryCollection.find
+  queries = []
+  def counted(collection, *args, **kwargs):
+    queries.append(collection.name)
+    return find(collection, *args, **kwargs)
+  db.memory.MemoryCollection.find = counted
+  try:
+    profiles = Profile.fetch(include=[Profile.owner])
+    assert sorted(queries) == ['Note', 'Profile', 'UserModel']
+    owners = [profile.owner.get() for profile in profiles]
+    assert len(queries) == 3
+    assert [owner.key.serialize() for owner in owners] == [profile.owner.serialize() for profile in profiles]
+  finally:
+    db.memory.MemoryCollection.find = find
+  print('include loads the referenced entities with one query per kind')
+
+
+def TestCredentialCache():
+  memory_backend()
+  with app_config() as client:
+    user = UserModel(email='cached@credentials.com')
+    user.set_password('old password')
+    user.save()
+    assert client.get('/users/', headers=basic_auth(user.email, 'old password')).status_code == 200
+    digest = user.credential_digest('old password')
+    assert dbmodels.verified_credentials.get(digest)
+
+    user.set_password('new password')
+    user.save()
+    assert not dbmodels.verified_credentials.get(digest)
+    assert client.get('/users/', headers=basic_auth(user.email, 'old password')).status_code == 401
+    assert client.get('/users/', headers=basic_auth(user.email, 'new password')).status_code == 200
+    assert client.get('/users/', headers=basic_auth(user.email, 'wrong')).status_code == 401
+  print('a cached credential is rejected once the password changes')
+
+
+def TestSessionTokens():
+  memory_backend()
+  with app_config() as client:
+    user = UserModel(email='session@tokens.com')
+    user.set_password('password')
+    user.save()
+
+    def token_for(password):
+      response = client.post('/sessions/', data=json.dumps({ 'email': user.email, 'password': password }),
+        content_type='application/json')
+      if response.status_code != 200: return None
+      return json.loads(response.data.decode('utf-8'))['token']
+
+    def status(token):
+      return client.get('/users/', headers={ 'Authorization': 'Bearer ' + token }).status_code
+
+    assert token_for('wrong') is None
+    token = token_for('password')
+    assert status(token) == 200
+
+    # only the first character of the signature is changed
+    payload, signature = token.rsplit('.', 1)
+    tampered = payload + '.' + ('A' if signature[0] != 'A' else 'B') + signature[1:]
+    assert status(tampered) == 401 and status('not.a.token') == 401
+
+    server.app.config['SESSION_MAX_AGE'], max_age = -1, server.app.config['SESSION_MAX_AGE']
+    try:
+      assert status(token) == 401
+    finally:
+      server.app.config['SESSION_MAX_AGE'] = max_age
+    assert status(token) == 200
+
+    # as another process would, the password is changed in the database
+    changed = UserModel(email=user.email)
+    changed.set_password('changed')
+    collection = db.get_backend().collection('UserModel')
+    collection.update_one({ '_id': db.model.ObjectId(user.key.id) }, { '$set': { 'password': changed.packed()['password'] } })
+    assert status(token) == 401
+    assert status(token_for('changed')) == 200
+
+  with app_config(SESSION_VERIFY_USER=False) as client:
+    response = client.get('/users/', headers={ 'Authorization': 'Bearer ' + token })
+    assert json.loads(response.data.decode('utf-8')) == { 'id': user.key.id, 'email': user.email }
+    partial = server.verify_session_token(token)
+    assert partial.password is None
+    try:
+      partial.save()
+      assert False, 'expected a PartialEntityError'
+    except db.PartialEntityError:
+      pass
+  print('session tokens expire, reject tampering and are revoked by password changes')
+
+
+def TestBusyHasher():
+  memory_backend()
+  with app_config(PASSWORD_HASH_MAX_PENDING=1) as client:
+    user = UserModel(email='busy@hasher.com')
+    user.set_password('password')
+    user.save()
+
+    # a stand in for a slow bcrypt job, it holds the only slot
+    release = threading.Event()
+    holder = threading.Thread(target=UserModel.hasher._run, args=(release.wait,))
+    holder.start()
+    while not UserModel.hasher.stats()['in_flight']: time.sleep(0.001)
+    # flask_restful logs a traceback for every 5xx response
+    server.app.logger.disabled = True
+    try:
+      for path, email in (('/users/', 'other@hasher.com'), ('/sessions/', user.email)):
+        body = json.dumps({ 'email': email, 'password': 'password' })
+        assert client.post(path, data=body, content_type='application/json').status_code == 503, path
+      assert client.get('/users/', headers=basic_auth(user.email, 'password')).status_code == 503
+      assert UserModel.hasher.stats()['rejected'] == 3
+    finally:
+      server.app.logger.disabled = False
+      release.set()
+      holder.join()
+    assert client.get('/users/', headers=basic_auth(user.email, 'password')).status_code == 200
+  print('requests needing a full password hasher are answered with 503')
+
+
+def run_behavior_tests():
+  TestGetMultiOrdering()
+  TestPutMultiErrors()
+  TestDirtyUpdates()
+  TestVersionedConflicts()
+  TestPartialSaves()
+  TestTripPagination()
+  TestFilters()
+  TestDeleteMulti()
+  TestEntityCache()
+  TestAtomicUpdates()
+  TestConfigureAndDeletes()
+  TestIndexesOnFirstRequest()
+  TestTripStreaming()
+  TestConcurrentAsyncRequests()
+  TestIdentityMap()
+  TestCountsAndSlices()
+  TestCompactRows()
+  TestRawDicts()
+  TestSerializers()
+  TestIncludeQueries()
+  TestCredentialCache()
+  TestSessionTokens()
+  TestBusyHasher()
+
+
 if __name__ == '__main__':
-  db.start_development_server()
-  # TestKeysandIds()
-  TestPropertyPacking()
+  if sys.argv[1:] == ['inspect']:
+    # the original manual checks, they need a running mongod
+    db.start_development_server()
+    # TestKeysandIds()
+    TestPropertyPacking()
+  else:
+    run_behavior_tests()
   
   
\ No newline at end of file
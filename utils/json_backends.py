@@ -0,0 +1,74 @@
+from itertools import islice
+
+from utils.mongo_json_encoder import JSONEncoder, default
+
+
+# Every backend turns a value into a JSON body (str or bytes) through
+# dumps, natively handling ObjectIds, db.Keys and bytes.
+class StdlibBackend(object):
+    name = 'stdlib'
+
+    def __init__(self):
+        # built once, encoders hold no per-call state
+        self._encoder = JSONEncoder(separators=(',', ':'))
+
+    def dumps(self, data):
+        return self._encoder.encode(data)
+
+
+class OrjsonBackend(object):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+
+    def dumps(self, data):
+        return self._dumps(data, default=default)
+
+
+BACKENDS = {
+    'stdlib': StdlibBackend,
+    'orjson': OrjsonBackend
+}
+
+_instances = {}
+
+
+# 'auto' picks the fastest installed backend
+def get_backend(name='auto'):
+    if name in _instances:
+        return _instances[name]
+    if name == 'auto':
+        try:
+            backend = get_backend('orjson')
+        except ImportError:
+            backend = get_backend('stdlib')
+    elif name in BACKENDS:
+        backend = BACKENDS[name]()
+    else:
+        raise ValueError('Unknown JSON backend %r' % name)
+    _instances[name] = backend
+    return backend
+
+
+# Encodes any iterable (a list, or a generator still reading from the
+# database) as a JSON array chunk_size items at a time so that a large
+# body can be sent as a chunked response while it is read and encoded
+def stream_array(backend, items, chunk_size=100):
+    items = iter(items)
+    yield '['
+    first = True
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            break
+        chunk = backend.dumps(chunk)
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8')
+        # strip the chunk's own brackets
+        if not first:
+            yield ','
+        yield chunk[1:-1]
+        first = False
+    yield ']'
@@ -1,10 +1,22 @@
 import json
 from bson.objectid import ObjectId
 
+from db import Key
+
 # Custom JSONEncoder that extracts the strings from MongoDB ObjectIDs
 # Thanks to http://stackoverflow.com/questions/16586180/typeerror-objectid-is-not-json-serializable
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
-        if isinstance(o, ObjectId):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
+        return default(o)
+
+
+# Converts the non JSON types our resources return, shared by every
+# encoder backend (see utils.json_backends)
+def default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, Key):
+        return o.id
+    if isinstance(o, bytes):
+        return o.decode('utf-8')
+    raise TypeError('%r is not JSON serializable' % (o,))
@@ -0,0 +1,95 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hasher already holds max_pending jobs, or when a
+    job did not finish within the timeout."""
+
+
+# Module level so that they can be sent to a process pool
+def _hashpw(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+def _checkpw(password, hashed):
+    return bcrypt.hashpw(password, hashed) == hashed
+
+
+# Runs bcrypt on a bounded worker pool so a burst of signups or logins
+# can only ever occupy `workers` cores. At most `max_pending` jobs are
+# held at once (running or queued), further jobs are rejected. A caller
+# waits at most `timeout` seconds for its job, its slot stays taken
+# until the job is done so abandoned jobs still count as pending.
+# Keep max_pending below the number of request threads, otherwise a
+# burst can block every request thread before anything is rejected.
+class PasswordHasher(object):
+    def __init__(self, rounds=12, workers=2, max_pending=4, processes=False, timeout=5):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processes = processes
+        self.timeout = timeout
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+
+    def hash(self, password):
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(_hashpw, password.encode('utf-8'), salt)
+
+    def check(self, password, hashed):
+        return self._run(_checkpw, password.encode('utf-8'), hashed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'in_flight': self._in_flight,
+                'queued': max(0, self._in_flight - self.workers),
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timed_out': self._timed_out
+            }
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PasswordHasherBusy('%d password hashes pending' % self.max_pending)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._pool().submit(function, *args)
+        except Exception:
+            self._done(None)
+            raise
+        # the slot is released when the job is done, not when we stop waiting
+        future.add_done_callback(self._done)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._timed_out += 1
+            raise PasswordHasherBusy('password hash took over %s seconds' % self.timeout)
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+
+    def _pool(self):
+        # created on first use so that pre-fork servers build it per worker
+        with self._lock:
+            if not self._executor:
+                executor = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+                self._executor = executor(max_workers=self.workers)
+            return self._executor